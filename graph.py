@@ -4,15 +4,36 @@ import pygame
 import serial
 import re
 import threading
+import Queue
 import sys
-from time import sleep
-from math import sqrt
+import os
+import argparse
+import resource
+import mmap
+import tempfile
+import struct
+import json
+import zipfile
+import multiprocessing
+import select
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from heapq import heappush, heappop
+from itertools import chain, islice, izip, imap
+from time import sleep, time as clocktime
+from math import sqrt, cos, exp
 
 Running = True
 
 Dimension = (1024,768)
 SeparatorPosition = Dimension[1] - 80
 
+# With several sources the plots are shown one at a time under a tab bar
+# ('tabs') or all at once one above the other ('stack')
+Layout = 'tabs'
+TabBarHeight = 0
+
 TIMEREVENT = pygame.USEREVENT + 1
 SERIALEVENT = pygame.USEREVENT + 2
 BgColor = pygame.Color(0, 0, 0, 255)
@@ -23,6 +44,9 @@ PosNodeColor = pygame.Color(255, 200, 220, 255)
 VelLineColor = pygame.Color(80, 150, 100, 255)
 VelNodeColor = pygame.Color(100, 255, 255, 255)
 
+OverlayPosColor = pygame.Color(110, 110, 160, 255)
+OverlayVelColor = pygame.Color(50, 90, 65, 255)
+
 HighlightNodeColor = pygame.Color(255, 255, 255, 255)
 
 PlotTextColor = pygame.Color(255, 255, 255, 255)
@@ -44,67 +68,422 @@ Font = None
 LineHeight = FontSize + 2
 BigFont = None
 
+# Traces denser than EnvelopeDensity samples per pixel column are drawn as
+# a min/max envelope, node circles only below NodeDensity samples per pixel
+EnvelopeDensity = 2.0
+NodeDensity = 0.25
+
+# While a run is streaming the plot axes are given headroom so that new samples
+# can be drawn incrementally: the time axis grows by TimeHeadroom times the run
+# length, the y axis is padded by RangeHysteresis of its swing on either side.
+TimeHeadroom = 1.5
+RangeHysteresis = 0.1
+
+# The main loop paints at most FrameRate frames per second and gives ingest
+# what painting leaves of a frame, but never less than MinIngestShare of it.
+# Ingest also yields as soon as any of InputEvents is waiting.
+FrameRate = 30
+MinIngestShare = 0.25
+# velocity filter chains Ctrl-V steps through, see VelocityFilter
+VelocityFilters = ['', 'reject:15:4', 'median:5', 'reject:15:4,ema:0.3', 'ma:8']
+InputEvents = [pygame.QUIT, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP,
+    pygame.MOUSEMOTION, pygame.VIDEORESIZE]
+
 # Mouse control states for the main loop
 DEFULAT = 0
 RESIZE = 1
-
+PAN = 2
+
+# Scrollback of up to MaxLines lines. Lines are packed newline-terminated
+# into byte chunks of about ChunkSize with an index of line start offsets.
+# When more than MemoryBudget bytes of chunks are held the oldest ones are
+# spilled to a memory-mapped temporary file, a quarter of the budget at a
+# time. Once most of the spill file holds dropped lines the rest is copied to
+# a new one, so it stays within a few times the scrollback. Lines are numbered by arrival;
+# the rendered surface of a line is cached on first paint and kept in LRU
+# order within SurfaceBudget.
 class Buffer:
-    last = ''
-    buf = [''] * 128
-    head = 0
-    count = 0
     OnChange = None
+    MaxLines = 4 * 1024 * 1024
+    ChunkSize = 1024 * 1024
+    MemoryBudget = 32 * 1024 * 1024
+    SurfaceBudget = 4 * 1024 * 1024
 
     def __init__(self):
         self.count = 0
+        self.first = 0
+        # offsets[n - dropped] is where line n starts
+        self.offsets = array('L')
+        self.dropped = 0
+        self.size = 0
+        # chunk k holds bytes from chunkstart[k] on; spilled chunks are None
+        # and live in the spill file, which starts at offset spillbase and
+        # is mapped up to spillend
+        self.chunks = []
+        self.chunkstart = array('L')
+        self.inmemory = 0
+        self.spilled = 0
+        self.spillfile = None
+        self.spillmap = None
+        self.spillbase = 0
+        self.spillend = 0
+        self.surfaces = OrderedDict()
+        self.surfacebytes = 0
 
     def Count(self):
-        return min(self.count, len(self.buf))
+        return self.count - self.first
+
+    # number of the oldest line still held
+    def First(self):
+        return self.first
+
+    # number the next line will get
+    def Total(self):
+        return self.count
 
     def NewLine(self, line):
-        self.head = (self.head + 1) % len(self.buf)
-        self.buf[self.head] = line
+        if len(self.chunks) == 0 or len(self.chunks[-1]) + len(line) + 1 > self.ChunkSize:
+            self.chunks.append(bytearray())
+            self.chunkstart.append(self.size)
+        self.chunks[-1].extend(line)
+        self.chunks[-1].append('\n')
+        self.offsets.append(self.size)
+        self.size = self.size + len(line) + 1
+        self.inmemory = self.inmemory + len(line) + 1
         self.count = self.count + 1
+
+        if self.count - self.first > self.MaxLines:
+            self.drop(self.count - self.MaxLines)
+        if self.inmemory > self.MemoryBudget:
+            self.spill()
+
         if self.OnChange != None:
             self.OnChange()
 
-    def Enumerate(self):
-        cursor = self.head
-        for count in xrange(len(self.buf)):
-            yield self.buf[cursor]
-            cursor = cursor - 1
-            if cursor < 0:
-                cursor = len(self.buf) - 1
+    # forget lines before first, releasing the chunks they alone occupied
+    def drop(self, first):
+        self.first = first
+        if first - self.dropped > self.MaxLines / 8:
+            del self.offsets[:first - self.dropped]
+            self.dropped = first
+            k = bisect_right(self.chunkstart, self.offsets[0]) - 1
+            for chunk in xrange(self.spilled, k):
+                if self.chunks[chunk] != None:
+                    self.inmemory = self.inmemory - len(self.chunks[chunk])
+                    self.chunks[chunk] = None
+            self.spilled = max(self.spilled, k)
+            if self.spillfile != None:
+                live = self.chunkstart[k]
+                if live >= self.spillend:
+                    self.closeSpill()
+                elif live - self.spillbase > (self.spillend - self.spillbase) / 2:
+                    self.respill(live)
+            # forget the entries of dropped chunks once they are most of them
+            if k > len(self.chunks) / 2:
+                del self.chunks[:k]
+                del self.chunkstart[:k]
+                self.spilled = self.spilled - k
+
+    # move the oldest chunks but the one being filled to the spill file
+    def spill(self):
+        if self.spillfile == None:
+            self.spillfile = tempfile.TemporaryFile(prefix='motorterm')
+            self.spillbase = self.chunkstart[self.spilled]
+        while self.inmemory > self.MemoryBudget * 3 / 4 and self.spilled < len(self.chunks) - 1:
+            chunk = self.chunks[self.spilled]
+            if chunk != None:
+                self.spillfile.seek(self.chunkstart[self.spilled] - self.spillbase)
+                self.spillfile.write(chunk)
+                self.inmemory = self.inmemory - len(chunk)
+                self.chunks[self.spilled] = None
+            self.spilled = self.spilled + 1
+        self.spillfile.flush()
+        end = self.chunkstart[self.spilled]
+        if end > self.spillbase:
+            self.spillend = end
+            self.spillfile.truncate(end - self.spillbase)
+            self.spillmap = mmap.mmap(self.spillfile.fileno(), end - self.spillbase, access=mmap.ACCESS_READ)
+
+    # copy the spilled bytes from offset start on to a new spill file
+    def respill(self, start):
+        spillfile = tempfile.TemporaryFile(prefix='motorterm')
+        for offset in xrange(start, self.spillend, self.ChunkSize):
+            spillfile.write(self.spillmap[offset - self.spillbase:min(offset + self.ChunkSize, self.spillend) - self.spillbase])
+        spillfile.flush()
+        end = self.spillend
+        self.closeSpill()
+        self.spillfile, self.spillbase, self.spillend = spillfile, start, end
+        self.spillmap = mmap.mmap(spillfile.fileno(), end - start, access=mmap.ACCESS_READ)
+
+    def closeSpill(self):
+        if self.spillmap != None:
+            self.spillmap.close()
+        self.spillfile.close()
+        self.spillfile, self.spillmap = None, None
+        self.spillbase = self.spillend = 0
+
+    # bytes and start offset of the chunk holding offset
+    def chunkAt(self, offset):
+        k = bisect_right(self.chunkstart, offset) - 1
+        if self.chunks[k] != None:
+            return self.chunks[k], self.chunkstart[k]
+        return self.spillmap, self.spillbase
+
+    def Line(self, number):
+        index = number - self.dropped
+        start = self.offsets[index]
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+        chunk, base = self.chunkAt(start)
+        return str(chunk[start - base:end - base - 1])
+
+    # line number at byte offset
+    def lineAt(self, offset):
+        return bisect_right(self.offsets, offset) - 1 + self.dropped
+
+    # Nearest line before (or after, if not backward) line number start
+    # matching the compiled regex, or None. Chunks are scanned directly, the
+    # offset index maps matches back to lines.
+    def Search(self, regex, start, backward=True):
+        if self.Count() == 0:
+            return None
+        lowest = self.offsets[self.first - self.dropped]
+        if backward:
+            if start <= self.first:
+                return None
+            limit = self.offsets[start - self.dropped] if start < self.count else self.size
+            while limit > lowest:
+                chunk, base = self.chunkAt(limit - 1)
+                first = max(lowest, self.chunkstart[bisect_right(self.chunkstart, limit - 1) - 1])
+                last = None
+                for m in regex.finditer(chunk, first - base, limit - base):
+                    last = m
+                if last != None:
+                    return self.lineAt(last.start() + base)
+                limit = first
+        else:
+            if start + 1 >= self.count:
+                return None
+            offset = self.offsets[max(start + 1, self.first) - self.dropped]
+            while offset < self.size:
+                chunk, base = self.chunkAt(offset)
+                k = bisect_right(self.chunkstart, offset)
+                end = self.chunkstart[k] if k < len(self.chunkstart) else self.size
+                m = regex.search(chunk, offset - base, end - base)
+                if m != None:
+                    return self.lineAt(m.start() + base)
+                offset = end
+        return None
+
+    # surface of line number, made by render(line) unless it is cached
+    def Surface(self, number, render):
+        surface = self.surfaces.pop(number, None)
+        if surface == None:
+            surface = render(self.Line(number))
+            self.surfacebytes = self.surfacebytes + surface.get_pitch() * surface.get_height()
+            while self.surfacebytes > self.SurfaceBudget and len(self.surfaces) > 0:
+                evicted = self.surfaces.popitem(last=False)[1]
+                self.surfacebytes = self.surfacebytes - evicted.get_pitch() * evicted.get_height()
+        self.surfaces[number] = surface
+        return surface
 
+    def Enumerate(self):
+        for number in xrange(self.count - 1, self.first - 1, -1):
+            yield self.Line(number)
+
+# Binary sample records travel in SLIP frames, END payload END, between the
+# text lines. A payload holds one or more records of RecordLayout fields,
+# each a little-endian 32 bit integer, with the same meaning as T=, Q= and
+# vel= of the text lines.
+SLIP_END, SLIP_ESC, SLIP_ESC_END, SLIP_ESC_ESC = '\xc0', '\xdb', '\xdc', '\xdd'
+RecordLayout = ('time', 'qenc', 'vel')
+RecordSize = 4 * len(RecordLayout)
+
+def SlipFrame(payload):
+    payload = payload.replace(SLIP_ESC, SLIP_ESC + SLIP_ESC_ESC).replace(SLIP_END, SLIP_ESC + SLIP_ESC_END)
+    return SLIP_END + payload + SLIP_END
+
+def SlipPayload(frame):
+    return frame.replace(SLIP_ESC + SLIP_ESC_END, SLIP_END).replace(SLIP_ESC + SLIP_ESC_ESC, SLIP_ESC)
+
+# Payloads of consecutive binary frames, decoded in one go by DataProtocol
+class Records:
+    def __init__(self, payloads):
+        self.payloads = payloads
+
+    def __len__(self):
+        return sum(len(payload) for payload in self.payloads) / RecordSize
+
+# Connections read on a thread of their own, split the input into lines and
+# hand them to the UI in batches through a bounded queue. A SERIALEVENT is
+# posted only when the UI may be waiting, that is after it found the queue
+# empty. Batches that do not fit in the queue are counted in dropped.
+# With Framing 'auto' SLIP framed records are told apart from text as soon
+# as a frame shows up and are queued as Records batches. Records of one read
+# are kept together ahead of the debug lines between them, but never moved
+# across a START or STOP line. 'text' leaves the input alone. A frame that
+# grows past MaxFrameSize counts as bad and its bytes go back to the text.
+# Input is read by step(), either on a reader thread of the connection's own
+# or by a Multiplexer that serves many connections from a single thread.
 class Connection(object):
     Open = False
     Enabled = False
+    QueueSize = 1024
+    Framing = 'auto'
+    # longest frame, escapes included, before an END is taken for noise and
+    # what followed it for text
+    MaxFrameSize = 2048
+    readerThread = None
+    multiplexer = None
+    # set when a multiplexer skipped the connection for want of queue room
+    stalled = False
 
     def __init__(self):
         self.Open = True
+        self.queue = Queue.Queue(self.QueueSize)
+        self.pending = False
+        self.partial = ''
+        self.inframe = False
+        self.frame = []
+        self.framesize = 0
+        self.dropped = 0
+        self.badframes = 0
+        # bytes read so far
+        self.received = 0
 
     def Send(self, key):
         pass
 
-    def ReceiveLine(self):
-        pass
+    # next batch of lines as (arrival time, lines), None when there is none;
+    # lines is a Records instance for a batch of binary records
+    def ReceiveBatch(self):
+        if self.stalled:
+            self.stalled = False
+            self.multiplexer.Wake()
+        try:
+            return self.queue.get_nowait()
+        except Queue.Empty:
+            self.pending = False
+        # a batch may have been queued before pending was cleared
+        try:
+            return self.queue.get_nowait()
+        except Queue.Empty:
+            return None
+
+    # like ReceiveBatch, but waits up to timeout seconds for a batch
+    def WaitBatch(self, timeout):
+        try:
+            return self.queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    # batches and lines queued and not yet received
+    def Backlog(self):
+        with self.queue.mutex:
+            return len(self.queue.queue), sum(len(batch[1]) for batch in self.queue.queue)
+
+    # whether the input is over and everything read has been received
+    def Drained(self):
+        return not self.Open and self.queue.empty()
 
     def Close(self):
         self.Open = False
 
+    # the reader starts with the first Enable, unless a multiplexer reads
     def Enable(self, value):
         self.Enabled = value
+        if self.multiplexer != None:
+            self.multiplexer.Wake()
+        elif value and self.readerThread == None:
+            self.startReader()
+
+    # file descriptor a multiplexer can wait on, None if always readable
+    def fileno(self):
+        return None
+
+    # whether a multiplexer may step() a connection without a file descriptor
+    def Room(self):
+        return False
+
+    def startReader(self):
+        self.readerThread = threading.Thread(target=self.ReaderThreadFunc, args=[])
+        self.readerThread.setDaemon(True)
+        self.readerThread.start()
+
+    # split data into complete lines, keeping the tail for the next call
+    def feed(self, data, stamp, block=False):
+        self.received = self.received + len(data)
+        if self.Framing == 'text' or (not self.inframe and SLIP_END not in data):
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()
+            if len(lines) > 0:
+                self.post(lines, stamp, block)
+            return
+
+        # every END opens or closes a frame
+        lines, payloads = [], []
+        for index, piece in enumerate(data.split(SLIP_END)):
+            if index > 0:
+                self.inframe = not self.inframe
+                if not self.inframe:
+                    payload = SlipPayload(''.join(self.frame))
+                    self.frame = []
+                    self.framesize = 0
+                    if len(payload) % RecordSize != 0:
+                        self.badframes = self.badframes + 1
+                    elif len(payload) > 0:
+                        if len(lines) > 0 and len(payloads) == 0:
+                            self.post(lines, stamp, block)
+                            lines = []
+                        payloads.append(payload)
+            if self.inframe:
+                self.frame.append(piece)
+                self.framesize = self.framesize + len(piece)
+                if self.framesize > self.MaxFrameSize:
+                    # a stray END, resync on the next one
+                    self.badframes = self.badframes + 1
+                    piece = ''.join(self.frame)
+                    self.frame = []
+                    self.framesize = 0
+                    self.inframe = False
+            if not self.inframe and len(piece) > 0:
+                # debug lines may overtake records, run markers may not
+                if len(payloads) > 0 and ('START' in piece or 'STOP' in piece):
+                    self.post(Records(payloads), stamp, block)
+                    payloads = []
+                text = (self.partial + piece).split('\n')
+                self.partial = text.pop()
+                lines.extend(text)
+        if len(lines) > 0:
+            self.post(lines, stamp, block)
+        if len(payloads) > 0:
+            self.post(Records(payloads), stamp, block)
+
+    def post(self, lines, stamp, block=False):
+        try:
+            self.queue.put((stamp, lines), block)
+        except Queue.Full:
+            self.dropped = self.dropped + len(lines)
+            return
+        if not self.pending:
+            self.pending = True
+            pygame.event.post(pygame.event.Event(SERIALEVENT))
+
+    def ReaderThreadFunc(self):
+        while self.Open:
+            if not self.Enabled:
+                sleep(0.01)
+                continue
+            self.step()
+
+    def step(self):
+        pass
 
 class SerialConnection(Connection):
     cer = None
-    pollThread = None
 
     def __init__(self, device, speed):
         super(SerialConnection, self).__init__()
         self.cer = serial.Serial(device, speed, timeout=1)
-        self.pollThread = threading.Thread(target=self.PollThreadFunc, args=[])
-        self.pollThread.setDaemon(True)
-        self.pollThread.start()
 
     def Send(self, key):
         try:
@@ -114,169 +493,1543 @@ class SerialConnection(Connection):
         except:
             return False
 
-    def ReceiveLine(self):
-        return self.cer.readline() if self.cer.inWaiting() > 0 else None
-
-    def PollThreadFunc(self):
-        while self.Open:
-            if self.Enabled and (self.cer.inWaiting() > 0):
-                pygame.event.post(pygame.event.Event(SERIALEVENT))
-            sleep(0.01)
+    def fileno(self):
+        return self.cer.fileno()
 
+    # block until at least a byte arrives, then take all that is waiting
+    def step(self):
+        try:
+            data = self.cer.read(max(self.cer.inWaiting(), 1))
+        except serial.SerialException:
+            self.Open = False
+            return
+        if len(data) > 0:
+            self.feed(data, clocktime())
+
+# A text log mapped into memory. An index thread goes through it once in
+# IndexBlock sized steps that end on a line, noting where each step starts,
+# how many lines come before it and where every START line is. That is enough
+# for a run list and for the line number of any offset. The index is kept
+# next to the log in a .mtidx file and reused while the log is unchanged.
+# The reader plays the whole log, or after Jump() a single run, from the map.
 class FileConnection(Connection):
-    pollThread = None
-    text = None
+    ReadSize = 64 * 1024
+    IndexBlock = 1024 * 1024
+    IndexMagic = 'MOTORLOG'
+    IndexHeader = struct.Struct('<8sQdIII')
+    StartLine = re.compile(r'^[ \t]*START[ \t\r]*$', re.M)
+    indexThread = None
 
     def __init__(self, file):
         super(FileConnection, self).__init__()
-        self.text = open(file, 'r')
-        self.pollThread = threading.Thread(target=self.PollThreadFunc, args=[])
-        self.pollThread.setDaemon(True)
-        self.pollThread.start()
-
-    def ReceiveLine(self):
-        line = self.text.readline()
-        if len(line) == 0:
+        self.text = open(file, 'rb')
+        self.size = os.fstat(self.text.fileno()).st_size
+        # an empty file cannot be mapped, an empty string reads the same
+        self.map = mmap.mmap(self.text.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else ''
+        self.indexpath = file + '.mtidx'
+        self.mtime = os.fstat(self.text.fileno()).st_mtime
+        self.position, self.stop = 0, self.size
+        self.current = None
+        self.blocks, self.lines, self.starts = array('L'), array('L'), array('L')
+        self.indexed = 0
+        # held while reading a block, so that Jump() can move a multiplexed reader
+        self.lock = threading.Lock()
+        if not self.loadIndex():
+            self.indexThread = threading.Thread(target=self.IndexThreadFunc, args=[])
+            self.indexThread.setDaemon(True)
+            self.indexThread.start()
+
+    # runs found so far as (start, stop) offsets, text before the first
+    # START counts as a run if there is any
+    def Runs(self):
+        indexed = self.indexed
+        starts = [start for start in self.starts if start < indexed]
+        if len(starts) == 0 or self.map[:starts[0]].strip() != '':
+            starts.insert(0, 0)
+        if indexed == 0:
+            return []
+        return zip(starts, starts[1:] + [indexed])
+
+    # line number at offset, as far as the index goes
+    def LineAt(self, offset):
+        k = bisect_right(self.blocks, offset) - 1
+        if k < 0:
+            return self.map[:offset].count('\n')
+        return self.lines[k] + self.map[self.blocks[k]:offset].count('\n')
+
+    def WaitIndex(self):
+        if self.indexThread != None:
+            self.indexThread.join()
+
+    # play run n on its own, stopping the current playback
+    def Jump(self, n):
+        runs = self.Runs()
+        if n < 0 or n >= len(runs):
+            return False
+        self.Open = False
+        while self.readerThread != None and self.readerThread.isAlive():
+            self.discard()
+            self.readerThread.join(0.01)
+        # a multiplexed reader may be waiting for queue room to finish a block
+        while not self.lock.acquire(False):
+            self.discard()
+            sleep(0.001)
+        self.discard()
+        self.partial, self.inframe, self.frame = '', False, []
+        self.pending = False
+        self.position, self.stop = runs[n]
+        self.current = n
+        self.Open = True
+        self.lock.release()
+        self.post(['--- run %d of %d%s, line %d ---' % (n + 1, len(runs),
+            '' if self.indexed == self.size else '+', self.LineAt(self.position) + 1)], clocktime())
+        if self.multiplexer != None:
+            self.multiplexer.Wake()
+        else:
+            self.startReader()
+        return True
+
+    # n and p step to the next and previous run
+    def Send(self, key):
+        if key == 'n':
+            return self.Jump(self.current + 1 if self.current != None else 0)
+        if key == 'p':
+            return self.Jump(self.current - 1 if self.current != None else len(self.Runs()) - 1)
+        return False
+
+    def discard(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    # A file is never dropped from, the reader waits for the UI instead. A
+    # multiplexer only reads a block when the queue has room for all of it,
+    # and is woken up by ReceiveBatch() when it had to pass the file over.
+    def Room(self):
+        self.stalled = self.queue.qsize() > self.QueueSize - 4
+        return not self.stalled
+
+    def step(self):
+        with self.lock:
+            if not self.Open:
+                return
+            end = min(self.position + self.ReadSize, self.stop)
+            data = self.map[self.position:end]
+            self.position = end
+            if len(data) == 0:
+                if len(self.partial) > 0:
+                    self.post([self.partial], clocktime(), True)
+                    self.partial = ''
+                self.Open = False
+                return
+            self.feed(data, clocktime(), True)
+
+    def IndexThreadFunc(self):
+        position, lines = 0, 0
+        while position < self.size:
+            end = self.map.find('\n', min(position + self.IndexBlock, self.size) - 1)
+            end = self.size if end < 0 else end + 1
+            block = self.map[position:end]
+            # lines first, LineAt() may look them up as soon as blocks grows
+            self.lines.append(lines)
+            self.blocks.append(position)
+            self.starts.extend(position + match.start() for match in self.StartLine.finditer(block))
+            lines = lines + block.count('\n')
+            position = end
+            self.indexed = position
+        self.saveIndex()
+
+    def loadIndex(self):
+        try:
+            with open(self.indexpath, 'rb') as f:
+                header = f.read(self.IndexHeader.size)
+                magic, size, mtime, block, blocks, starts = self.IndexHeader.unpack(header)
+                if magic != self.IndexMagic or size != self.size or mtime != self.mtime or block != self.IndexBlock:
+                    return False
+                values = struct.unpack('<%dQ' % (2 * blocks + starts), f.read(8 * (2 * blocks + starts)))
+        except (IOError, struct.error):
+            return False
+        self.blocks = array('L', values[:blocks])
+        self.lines = array('L', values[blocks:2 * blocks])
+        self.starts = array('L', values[2 * blocks:])
+        self.indexed = self.size
+        return True
+
+    # a log in a read-only place just gets indexed again next time
+    def saveIndex(self):
+        try:
+            with open(self.indexpath, 'wb') as f:
+                f.write(self.IndexHeader.pack(self.IndexMagic, self.size, self.mtime, self.IndexBlock,
+                    len(self.blocks), len(self.starts)))
+                values = chain(self.blocks, self.lines, self.starts)
+                f.write(struct.pack('<%dQ' % (2 * len(self.blocks) + len(self.starts)), *values))
+        except IOError:
+            pass
+
+# Reads any number of serial and file connections on a single thread: ports
+# are waited on together with select(), files are read a block at a time in
+# turn whenever their queue has room. Wake() interrupts the wait when a
+# connection is enabled, moved or has room again. select() on serial ports
+# needs POSIX, elsewhere each connection keeps a reader thread of its own.
+class Multiplexer:
+    Supported = os.name == 'posix'
+
+    def __init__(self):
+        self.connections = []
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self.ThreadFunc, args=[])
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def Add(self, connection):
+        connection.multiplexer = self
+        self.connections.append(connection)
+        self.Wake()
+
+    def Wake(self):
+        os.write(self.wakeup[1], 'w')
+
+    def ThreadFunc(self):
+        while True:
+            ready = [c for c in self.connections if c.Open and c.Enabled]
+            ports = dict((c.fileno(), c) for c in ready if c.fileno() != None)
+            files = [c for c in ready if c.fileno() == None and c.Room()]
+            readable = select.select([self.wakeup[0]] + ports.keys(), [], [], 0 if files else None)[0]
+            for fd in readable:
+                if fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                else:
+                    ports[fd].step()
+            for connection in files:
+                connection.step()
+
+# Generated screenlog.0 style input of count samples, for benchmarks, as text
+# lines or, if binary, as SLIP framed records between the debug lines. Input
+# is made on demand when a batch is asked for, so generating it does not
+# compete with the consumer for the interpreter.
+class SyntheticConnection(Connection):
+    BatchSize = 1000
+
+    def __init__(self, count, binary=False):
+        super(SyntheticConnection, self).__init__()
+        self.lines = chain(['START'], SampleLines(count))
+        self.chunks = chain(['START\n'], SampleFrames(count)) if binary else None
+
+    def ReceiveBatch(self):
+        if self.chunks != None:
+            while self.queue.empty() and self.Open:
+                chunk = next(self.chunks, None)
+                if chunk == None:
+                    self.Open = False
+                else:
+                    self.feed(chunk, clocktime())
+            return Connection.ReceiveBatch(self)
+        batch = list(islice(self.lines, self.BatchSize))
+        if len(batch) == 0:
             self.Open = False
             return None
-        return line
+        self.received = self.received + sum(len(line) + 1 for line in batch)
+        return (clocktime(), batch)
+
+    def WaitBatch(self, timeout):
+        return self.ReceiveBatch()
+
+    # batches are made on demand by ReceiveBatch, there is nothing to read
+    def startReader(self):
+        pass
+
+# A capture file is a header followed by blocks of tag, length and payload:
+# LINE holds received text lines joined by newlines, SAMP raw samples packed
+# like binary records, STRT and STOP mark the run boundaries. On Close an INDX
+# block lists every run as (offset, samples, lines) and the footer points at
+# it, so a capture opens without reading the blocks. A capture that was never
+# closed is indexed by skipping from block header to block header instead.
+CaptureMagic = 'MOTORCAP'
+CaptureVersion = 1
+CaptureHeader = struct.Struct('<8sI')
+CaptureBlock = struct.Struct('<4sI')
+CaptureFooter = struct.Struct('<Q8s')
+CaptureIndexMagic = 'MOTORIDX'
+
+def IsCapture(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(CaptureMagic)) == CaptureMagic
+    except IOError:
+        return False
+
+# Records a session as DataProtocol and the UI hand it over, in blocks of up
+# to FlushSize bytes. Samples before the first START make a run of their own.
+class CaptureWriter:
+    FlushSize = 256 * 1024
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(CaptureHeader.pack(CaptureMagic, CaptureVersion))
+        self.lines = []
+        self.linebytes = 0
+        self.samples = array('i')
+        self.runs = []
+
+    def Lines(self, lines):
+        if len(lines) == 0:
+            return
+        if len(self.runs) == 0:
+            self.runs.append([self.file.tell(), 0, 0])
+        self.lines.extend(lines)
+        self.linebytes = self.linebytes + sum(len(line) + 1 for line in lines)
+        self.runs[-1][2] += len(lines)
+        if self.linebytes >= self.FlushSize:
+            self.flush()
+
+    def Samples(self, times, qencs, periods):
+        if len(self.runs) == 0:
+            self.runs.append([self.file.tell(), 0, 0])
+        fields = len(RecordLayout)
+        values = array('i', [0]) * (fields * len(times))
+        for index, column in enumerate((times, qencs, periods)):
+            values[index::fields] = array('i', column)
+        self.samples.extend(values)
+        self.runs[-1][1] += len(times)
+        if len(self.samples) * 4 >= self.FlushSize:
+            self.flush()
+
+    def Start(self):
+        self.flush()
+        self.runs.append([self.file.tell(), 0, 0])
+        self.block('STRT', '')
+
+    def Stop(self):
+        self.flush()
+        self.block('STOP', '')
+
+    def Close(self):
+        self.flush()
+        offset = self.file.tell()
+        self.block('INDX', struct.pack('<%dQ' % (3 * len(self.runs)), *chain(*self.runs)))
+        self.file.write(CaptureFooter.pack(offset, CaptureIndexMagic))
+        self.file.close()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            self.block('LINE', '\n'.join(self.lines))
+            self.lines = []
+            self.linebytes = 0
+        if len(self.samples) > 0:
+            if sys.byteorder == 'big':
+                self.samples.byteswap()
+            self.block('SAMP', self.samples.tostring())
+            self.samples = array('i')
+
+    def block(self, tag, payload):
+        self.file.write(CaptureBlock.pack(tag, len(payload)))
+        self.file.write(payload)
+
+# A capture file mapped into memory. Runs() lists (offset, samples, lines)
+# per run, LoadRun() replays the blocks of one run only.
+class Capture:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < CaptureHeader.size or \
+                CaptureHeader.unpack_from(self.map)[0] != CaptureMagic:
+            raise ValueError('%s is not a motorterm capture' % path)
+        self.end = len(self.map)
+        self.runs = self.readIndex()
+        if self.runs == None:
+            self.runs = self.scan()
+
+    def Runs(self):
+        return self.runs
+
+    def Close(self):
+        self.map.close()
+        self.file.close()
+
+    # feed run n to protocol and its text lines to buffa if given
+    def LoadRun(self, n, protocol, buffa=None):
+        start = self.runs[n][0]
+        stop = self.runs[n + 1][0] if n + 1 < len(self.runs) else self.end
+        protocol.Start()
+        for tag, offset, length in self.blocks(start, stop):
+            payload = self.map[offset:offset + length]
+            if tag == 'SAMP':
+                protocol.ProcessRecords(Records([payload]))
+            elif tag == 'LINE' and buffa != None:
+                for line in payload.split('\n'):
+                    buffa.NewLine(line)
+            elif tag == 'STOP':
+                protocol.Finish()
+
+    def blocks(self, start, stop):
+        offset = start
+        while offset + CaptureBlock.size <= stop:
+            tag, length = CaptureBlock.unpack_from(self.map, offset)
+            offset = offset + CaptureBlock.size
+            if offset + length > stop:
+                # cut short by a crash while recording
+                break
+            yield tag, offset, length
+            offset = offset + length
+
+    def readIndex(self):
+        if self.end < CaptureHeader.size + CaptureBlock.size + CaptureFooter.size:
+            return None
+        offset, magic = CaptureFooter.unpack_from(self.map, self.end - CaptureFooter.size)
+        if magic != CaptureIndexMagic or offset + CaptureBlock.size > self.end - CaptureFooter.size:
+            return None
+        tag, length = CaptureBlock.unpack_from(self.map, offset)
+        if tag != 'INDX' or length % 24 != 0:
+            return None
+        values = struct.unpack_from('<%dQ' % (length / 8), self.map, offset + CaptureBlock.size)
+        self.end = offset
+        return [list(values[i:i + 3]) for i in xrange(0, len(values), 3)]
+
+    def scan(self):
+        runs = []
+        for tag, offset, length in self.blocks(CaptureHeader.size, self.end):
+            if tag == 'STRT' or len(runs) == 0:
+                runs.append([offset - CaptureBlock.size, 0, 0])
+            if tag == 'SAMP':
+                runs[-1][1] += length / RecordSize
+            elif tag == 'LINE':
+                runs[-1][2] += self.map[offset:offset + length].count('\n') + 1
+        return runs
+
+# Browses a capture one run at a time, n and p step to the next and previous
+# run. Nothing arrives through the queue, runs are loaded straight into the
+# protocol and buffer given to Attach().
+class CaptureConnection(Connection):
+    def __init__(self, path):
+        super(CaptureConnection, self).__init__()
+        self.capture = Capture(path)
+        self.current = None
+        self.protocol = None
+        self.buffa = None
+
+    def Attach(self, protocol, buffa):
+        self.protocol, self.buffa = protocol, buffa
+        self.Jump(0)
+
+    # runs are loaded by Jump, there is nothing to read
+    def startReader(self):
+        pass
+
+    def Jump(self, n):
+        runs = self.capture.Runs()
+        if len(runs) == 0 or n < 0 or n >= len(runs) or n == self.current:
+            return False
+        self.current = n
+        self.buffa.NewLine('--- run %d of %d, %d samples ---' % (n + 1, len(runs), runs[n][1]))
+        self.capture.LoadRun(n, self.protocol, self.buffa)
+        return True
+
+    def Send(self, key):
+        if key == 'n' and self.current != None:
+            return self.Jump(self.current + 1)
+        if key == 'p' and self.current != None:
+            return self.Jump(self.current - 1)
+        return False
+
+    def Close(self):
+        super(CaptureConnection, self).Close()
+        self.capture.Close()
+
+# Runs written out as files in the background, one file per run named
+# <name>-run<N>.<format> in a directory. csv has a header line and time in
+# ms, position and velocity per line. npy is a structured array of float64
+# time, int32 position and float32 velocity, npz holds the three columns as
+# time.npy, qenc.npy and vel.npy, like numpy.savez. The runs are PastRun
+# copies, written a chunk at a time so that nothing else is copied whole,
+# to a .part file renamed once complete. Times relative to the first sample
+# keep the 0.1 ms tick of long runs only in double precision.
+ExportFormats = ('csv', 'npy', 'npz')
+ExportColumns = (('time', '<f8'), ('qenc', '<i4'), ('vel', '<f4'))
+# array typecodes of the exported columns
+ExportTypes = ('d', 'i', 'f')
+
+# the header of a version 1.0 .npy file of count items of descr
+def NpyHeader(descr, count):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (descr, count)
+    # magic, version and length take 10 bytes, the data starts 16 byte aligned
+    header = header + ' ' * (15 - (10 + len(header)) % 16) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+class RunExporter:
+    Chunk = 65536
+
+    def __init__(self, directory='.', format='csv'):
+        if format not in ExportFormats:
+            raise ValueError('Unknown export format %s, use one of %s' % (format, ', '.join(ExportFormats)))
+        self.directory = directory
+        self.format = format
+        self.jobs = Queue.Queue()
+        self.thread = threading.Thread(target=self.ThreadFunc, args=[])
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    # queue a PastRun for writing, returns the path it will be written to
+    def Export(self, run, name):
+        path = os.path.join(self.directory, '%s-run%d.%s' % (name, run.number, self.format))
+        self.jobs.put((run, path))
+        return path
+
+    # wait for the queued runs to be written
+    def Close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def ThreadFunc(self):
+        while True:
+            job = self.jobs.get()
+            if job == None:
+                return
+            run, path = job
+            try:
+                getattr(self, 'write' + self.format.capitalize())(run, path + '.part')
+                os.rename(path + '.part', path)
+                print 'Exported run %d, %d samples to %s' % (run.number, run.count, path)
+            except EnvironmentError as e:
+                print 'Could not export run %d to %s: %s' % (run.number, path, e)
+
+    # slices of at most Chunk samples of the run columns at the given
+    # indices, as ExportTypes and with times relative to the start of the run
+    def chunks(self, run, indices):
+        for start in xrange(0, run.count, self.Chunk):
+            stop = min(start + self.Chunk, run.count)
+            pieces = []
+            for index in indices:
+                piece = run.columns[index][start:stop]
+                if index == 0:
+                    pieces.append(array('d', (t - run.start for t in piece)))
+                else:
+                    pieces.append(array(ExportTypes[index], piece))
+            yield pieces
+            # let the UI thread have the interpreter between chunks
+            sleep(0)
+
+    def writeCsv(self, run, path):
+        with open(path, 'w') as out:
+            out.write('time_ms,position,velocity\n')
+            for times, qencs, vels in self.chunks(run, (0, 1, 2)):
+                out.write(''.join('%.1f,%d,%g\n' % row for row in izip(times, qencs, vels)))
+
+    # rows interleaved as 32 bit words, each column in little-endian order
+    # reinterpreted as words of its items
+    def writeNpy(self, run, path):
+        width = sum(array(typecode).itemsize for typecode in ExportTypes) / 4
+        with open(path, 'wb') as out:
+            out.write(NpyHeader(list(ExportColumns), run.count))
+            for chunk in self.chunks(run, (0, 1, 2)):
+                rows = array('i', [0]) * (width * len(chunk[0]))
+                first = 0
+                for column in chunk:
+                    if sys.byteorder == 'big':
+                        column.byteswap()
+                    words = array('i', column.tostring())
+                    size = column.itemsize / 4
+                    for word in xrange(size):
+                        rows[first + word::width] = words[word::size]
+                    first = first + size
+                out.write(rows.tostring())
+
+    # every column is written to a .npy file of its own and stored in the zip
+    # from there, zipfile in Python 2 cannot stream into an archive member
+    def writeNpz(self, run, path):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, True) as archive:
+            for index, (name, descr) in enumerate(ExportColumns):
+                member = '%s.%s.npy' % (path, name)
+                try:
+                    with open(member, 'wb') as out:
+                        out.write(NpyHeader(descr, run.count))
+                        for piece, in self.chunks(run, [index]):
+                            if sys.byteorder == 'big':
+                                piece.byteswap()
+                            out.write(piece.tostring())
+                    archive.write(member, name + '.npy')
+                finally:
+                    if os.path.exists(member):
+                        os.remove(member)
+
+# Running min/max of a growing column kept at power-of-two block sizes.
+# Level 0 is the column itself, level k holds the min and max of every block
+# of 2**k consecutive values, the last block of each level being partial while
+# the column grows. Appending is O(log n), min/max of any aligned block is O(1).
+class MinMaxPyramid:
+    def __init__(self, values):
+        self.values = values
+        self.Clear()
+
+    def Clear(self):
+        self.count = 0
+        self.mins = [self.values]
+        self.maxs = [self.values]
+
+    def Count(self):
+        return self.count
+
+    # value must already be stored at values[Count()]
+    def Append(self, value):
+        n = self.count
+        self.count = n + 1
+        for level in xrange(1, len(self.mins)):
+            mins, maxs = self.mins[level], self.maxs[level]
+            block = n >> level
+            if block == len(mins):
+                mins.append(value)
+                maxs.append(value)
+            else:
+                if value < mins[block]: mins[block] = value
+                if value > maxs[block]: maxs[block] = value
+        if (n >> (len(self.mins) - 1)) > 0:
+            # grow a new top level made of the two blocks below it
+            mins, maxs = self.mins[-1], self.maxs[-1]
+            self.mins.append(array('d', [min(mins[0], mins[1])]))
+            self.maxs.append(array('d', [max(maxs[0], maxs[1])]))
+
+    # Account for values[Count():count] stored at once. Only the blocks the
+    # new values fall in are recomputed, level by level from the pairs below.
+    def Extend(self, count):
+        old = self.count
+        if count <= old:
+            return
+        self.count = count
+        level = 1
+        while ((count - 1) >> (level - 1)) > 0:
+            if level == len(self.mins):
+                self.mins.append(array('d'))
+                self.maxs.append(array('d'))
+            first = old >> level
+            lo, hi = 2 * first, ((count - 1) >> (level - 1)) + 1
+            pairs = lo + (hi - lo) / 2 * 2
+            for below, blocks, pick in ((self.mins[level - 1], self.mins[level], min),
+                                        (self.maxs[level - 1], self.maxs[level], max)):
+                merged = map(pick, below[lo:pairs:2], below[lo + 1:pairs:2])
+                if pairs < hi:
+                    merged.append(below[pairs])
+                blocks[first:] = array('d', merged)
+            level = level + 1
+
+    # First index below Count() whose value passes test(value, value), or the
+    # last one if last, -1 if there is none. test(min, max) of a block must
+    # hold whenever it holds for a value in the block, so a descent only
+    # enters blocks holding a match and takes O(log n).
+    def Find(self, test, last=False):
+        mins, maxs = self.mins, self.maxs
+        top = len(mins) - 1
+        stack = range(len(mins[top]) if top > 0 else self.count)
+        if not last:
+            stack.reverse()
+        stack = [(top, block) for block in stack]
+        while stack:
+            level, block = stack.pop()
+            if (block << level) >= self.count or not test(mins[level][block], maxs[level][block]):
+                continue
+            if level == 0:
+                return block
+            if last:
+                stack.extend(((level - 1, 2 * block), (level - 1, 2 * block + 1)))
+            else:
+                stack.extend(((level - 1, 2 * block + 1), (level - 1, 2 * block)))
+        return -1
+
+    # Index of the value nearest to some point and its distance, or (-1, None)
+    # if none is within limit. bound(first, last, min, max) is the least
+    # distance any of values[first:last] can have given their min and max, for
+    # a single value its exact distance. Blocks are visited nearest first like
+    # the boxes of a bounding volume hierarchy, so only the blocks around the
+    # point are entered and a lookup takes O(log n) steps on most data. Gives
+    # up and returns None after steps blocks if steps is given.
+    def Nearest(self, bound, limit, steps=None):
+        mins, maxs = self.mins, self.maxs
+        count = self.count
+        top = len(mins) - 1
+        heap = []
+        def visit(level, block):
+            first = block << level
+            if first < count:
+                distance = bound(first, min(first + (1 << level), count), mins[level][block], maxs[level][block])
+                if distance <= limit:
+                    heappush(heap, (distance, level, block))
+        for block in xrange(len(mins[top]) if top > 0 else count):
+            visit(top, block)
+        while heap:
+            distance, level, block = heappop(heap)
+            if level == 0:
+                return block, distance
+            if steps != None:
+                steps = steps - 1
+                if steps < 0:
+                    return None
+            visit(level - 1, 2 * block)
+            visit(level - 1, 2 * block + 1)
+        return -1, None
+
+    def Levels(self):
+        return len(self.mins)
+
+    def Block(self, level, block):
+        return self.mins[level][block], self.maxs[level][block]
+
+    # min and max of values[lo:hi], O(log n) aligned blocks
+    def Range(self, lo, hi):
+        mins, maxs = self.mins, self.maxs
+        lowest, highest = self.values[lo], self.values[lo]
+        level = 0
+        while lo < hi:
+            if lo & 1:
+                if mins[level][lo] < lowest: lowest = mins[level][lo]
+                if maxs[level][lo] > highest: highest = maxs[level][lo]
+                lo = lo + 1
+            if hi & 1:
+                hi = hi - 1
+                if mins[level][hi] < lowest: lowest = mins[level][hi]
+                if maxs[level][hi] > highest: highest = maxs[level][hi]
+            lo, hi = lo >> 1, hi >> 1
+            level = level + 1
+        return lowest, highest
+
+# Index of level crossings of a continuous piecewise-linear trace.
+# A segment (i, i+1) crosses level y when y lies in (min, max] of its ends.
+# Because the trace is continuous, any run of samples that has values both
+# below y and at or above y contains at least one crossing, so a descent of
+# the min/max pyramid only visits blocks that actually hold crossings.
+class CrossingIndex:
+    def __init__(self, values):
+        self.pyramid = MinMaxPyramid(values)
+        self.Clear()
+
+    def Clear(self):
+        self.pyramid.Clear()
+        self.level = None
+        self.limit = 0
+        self.segments = []
+
+    def Append(self, value):
+        self.pyramid.Append(value)
+
+    def Extend(self, count):
+        self.pyramid.Extend(count)
+
+    # indices i of segments (i, i+1) crossing y, for i + 1 < limit
+    def Query(self, y, limit):
+        found = []
+        if limit < 2:
+            return found
+        values = self.pyramid.values
+        mins, maxs = self.pyramid.mins, self.pyramid.maxs
+        top = self.pyramid.Levels() - 1
+        last = limit - 1
+        stack = [(top, b) for b in xrange(len(mins[top]) - 1, -1, -1)]
+        while stack:
+            level, block = stack.pop()
+            start = block << level
+            if start >= last:
+                continue
+            end = min((block + 1) << level, last)
+            # the block plus the first sample of the next one bound its segments
+            lo, hi = mins[level][block], maxs[level][block]
+            if values[end] < lo: lo = values[end]
+            if values[end] > hi: hi = values[end]
+            if not (lo < y <= hi):
+                continue
+            if level == 0:
+                found.append(start)
+            else:
+                stack.append((level - 1, 2 * block + 1))
+                stack.append((level - 1, 2 * block))
+        return found
+
+    # keep the crossings of level y over the first limit samples up to date
+    def Update(self, y, limit):
+        if y != self.level or limit < self.limit:
+            self.segments = self.Query(y, limit)
+        else:
+            values = self.pyramid.values
+            for i in xrange(max(self.limit - 1, 0), limit - 1):
+                a, b = values[i], values[i + 1]
+                if min(a, b) < y <= max(a, b):
+                    self.segments.append(i)
+        self.level, self.limit = y, limit
+        return self.segments
+
+# Read-only sequence of (x, y) pairs over two store columns. Slicing gives
+# another view, nothing is copied until an element is accessed.
+class SampleView:
+    def __init__(self, xs, ys, start, stop):
+        self.xs, self.ys = xs, ys
+        self.start, self.stop = start, stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return SampleView(self.xs, self.ys, self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index = index + len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('sample index out of range')
+        index = index + self.start
+        return (self.xs[index], self.ys[index])
+
+    def __iter__(self):
+        xs, ys = self.xs, self.ys
+        for i in xrange(self.start, self.stop):
+            yield (xs[i], ys[i])
+
+# Columnar sample storage: time, encoder, velocity and the velocity before
+# filtering each in a typed array, 32 bytes per sample instead of tuples of
+# boxed numbers. Keeping raw lets a new filter redo the whole run.
+# Columns grow by doubling so appends are amortized O(1), only the first
+# count entries are valid.
+class SampleStore:
+    InitialCapacity = 1024
+
+    def __init__(self):
+        self.time = array('d', [0.0]) * self.InitialCapacity
+        self.qenc = array('l', [0]) * self.InitialCapacity
+        self.vel = array('d', [0.0]) * self.InitialCapacity
+        self.raw = array('d', [0.0]) * self.InitialCapacity
+        self.columns = [self.time, self.qenc, self.vel, self.raw]
+        self.count = 0
+
+    # forget all samples, shrinking the columns in place so that views into
+    # them (crossing index, pyramids) stay attached
+    def Clear(self):
+        for column in self.columns:
+            del column[self.InitialCapacity:]
+        self.count = 0
+
+    def Append(self, time, qenc, vel, raw):
+        n = self.count
+        if n == len(self.time):
+            for column in self.columns:
+                column.extend(array(column.typecode, [0]) * n)
+        self.time[n], self.qenc[n], self.vel[n], self.raw[n] = time, qenc, vel, raw
+        self.count = n + 1
+
+    # append columns of samples at once
+    def Extend(self, times, qencs, vels, raws):
+        n, k = self.count, len(times)
+        capacity = len(self.time)
+        while n + k > capacity:
+            capacity = capacity * 2
+        if capacity > len(self.time):
+            for column in self.columns:
+                column.extend(array(column.typecode, [0]) * (capacity - len(column)))
+        self.time[n:n + k] = array('d', times)
+        self.qenc[n:n + k] = array('l', qencs)
+        self.vel[n:n + k] = array('d', vels)
+        self.raw[n:n + k] = array('d', raws)
+        self.count = n + k
+
+    def At(self, index):
+        return (self.time[index], self.qenc[index], self.vel[index])
+
+    def View(self, index, start=0, stop=None):
+        return SampleView(self.time, self.columns[index], start, self.count if stop == None else stop)
+
+    # forget the first samples, moving the rest to the front in place
+    def Forget(self, first):
+        for column in self.columns:
+            del column[:first]
+        self.count = self.count - first
+
+# Min and max over a sliding window of a stream from two monotonic deques of
+# (number, value): candidates for the min have increasing values, those for
+# the max decreasing ones. Every value goes in and out of each deque once, so
+# keeping the range up to date is O(1) amortized per value.
+class SlidingRange:
+    def __init__(self):
+        self.Clear()
+
+    def Clear(self):
+        self.mins = deque()
+        self.maxs = deque()
+
+    def Push(self, number, value):
+        mins, maxs = self.mins, self.maxs
+        while len(mins) > 0 and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((number, value))
+        while len(maxs) > 0 and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((number, value))
+
+    # forget the values numbered below first
+    def Expire(self, first):
+        for candidates in (self.mins, self.maxs):
+            while len(candidates) > 0 and candidates[0][0] < first:
+                candidates.popleft()
+
+    def Range(self):
+        return [self.mins[0][1], self.maxs[0][1]]
+
+# A finished run kept for comparison with later ones and for export. The
+# columns are slices of the store, a copy at C speed even on the UI thread:
+# times stay on the clock of the store with start that of the first sample,
+# and ranges are (min, max) per column, None for time, given by the caller.
+class PastRun:
+    def __init__(self, number, store, ranges):
+        count = store.count
+        self.number = number
+        self.count = count
+        self.start = store.time[0]
+        self.time = store.time[:count]
+        self.qenc = store.qenc[:count]
+        self.vel = store.vel[:count]
+        self.columns = [self.time, self.qenc, self.vel]
+        self.ranges = ranges
+
+    def Duration(self):
+        return self.time[-1] - self.start
+
+    def Size(self):
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+# Streaming velocity filters. Each takes one value at a time and keeps only
+# what its window needs: Step() is O(1), O(log w) comparisons for the median.
+# Reset() forgets the history at the start of a run.
+
+# mean of the last window values from a running sum
+class MovingAverage:
+    def __init__(self, window):
+        self.window = max(int(window), 1)
+        self.Reset()
+
+    def Reset(self):
+        self.values = deque()
+        self.total = 0.0
+
+    def Step(self, value):
+        self.values.append(value)
+        self.total = self.total + value
+        if len(self.values) > self.window:
+            self.total = self.total - self.values.popleft()
+        return self.total / len(self.values)
+
+# exponential moving average, alpha is the weight of the newest value
+class ExponentialAverage:
+    def __init__(self, alpha):
+        self.alpha = min(max(float(alpha), 0.0), 1.0)
+        self.Reset()
+
+    def Reset(self):
+        self.value = None
+
+    def Step(self, value):
+        if self.value == None:
+            self.value = value
+        else:
+            self.value = self.value + self.alpha * (value - self.value)
+        return self.value
+
+# median of the last window values, kept sorted next to the arrival order
+class RunningMedian:
+    def __init__(self, window):
+        self.window = max(int(window), 1)
+        self.Reset()
+
+    def Reset(self):
+        self.values = deque()
+        self.sorted = []
+
+    def Step(self, value):
+        self.values.append(value)
+        insort(self.sorted, value)
+        if len(self.values) > self.window:
+            del self.sorted[bisect_left(self.sorted, self.values.popleft())]
+        n = len(self.sorted)
+        if n % 2 == 1:
+            return self.sorted[n / 2]
+        return (self.sorted[n / 2 - 1] + self.sorted[n / 2]) / 2.0
+
+# Replace a value by the median of the last window values when it is further
+# from it than factor times the typical deviation. The typical deviation starts
+# as the median absolute deviation of the first full window and then averages
+# the recent deviations, clipped at the limit so outliers barely move it.
+# Single bad periods from the board then don't reach the plot.
+class OutlierReject:
+    def __init__(self, window, factor=4.0):
+        self.median = RunningMedian(window)
+        self.factor = float(factor)
+        self.spread = ExponentialAverage(2.0 / (self.median.window + 1))
+
+    def Reset(self):
+        self.median.Reset()
+        self.spread.Reset()
+
+    def Step(self, value):
+        median = self.median.Step(value)
+        if len(self.median.values) < self.median.window:
+            return value
+        if self.spread.value == None:
+            deviations = sorted(abs(v - median) for v in self.median.values)
+            self.spread.Step(deviations[len(deviations) / 2])
+        deviation = abs(value - median)
+        limit = self.factor * self.spread.value
+        # nothing is rejected until the values have spread at all
+        if limit > 0 and deviation > limit:
+            self.spread.Step(limit)
+            return median
+        self.spread.Step(deviation)
+        return value
+
+# Chain of velocity filters from a spec like 'reject:15:4,median:5,ema:0.3',
+# applied left to right. Raises ValueError on an unknown filter or argument.
+class VelocityFilter:
+    Filters = OrderedDict((('ma', MovingAverage), ('ema', ExponentialAverage),
+        ('median', RunningMedian), ('reject', OutlierReject)))
+
+    def __init__(self, spec=''):
+        self.spec = spec.strip()
+        self.filters = []
+        for token in filter(None, [token.strip() for token in self.spec.split(',')]):
+            fields = token.split(':')
+            if fields[0] not in self.Filters:
+                raise ValueError('Unknown velocity filter %s, use one of %s' % (fields[0], ', '.join(self.Filters)))
+            try:
+                self.filters.append(self.Filters[fields[0]](*[float(arg) for arg in fields[1:]]))
+            except TypeError:
+                raise ValueError('Wrong number of arguments to velocity filter %s' % token)
+
+    def Reset(self):
+        for stage in self.filters:
+            stage.Reset()
+
+    def Step(self, value):
+        for stage in self.filters:
+            value = stage.Step(value)
+        return value
+
+    # filter a whole column in one pass, stage by stage
+    def Apply(self, values):
+        self.Reset()
+        for stage in self.filters:
+            values = map(stage.Step, values)
+        return values
+
+# Layout of sample lines: KEY=role fields in the order they appear on a line,
+# e.g. 'T=time Q=qenc vel=vel S=steps?'. Roles time, qenc and vel are
+# required, any other role is kept as an extra integer column. A field
+# ending in ? may be missing from a line. The schema compiles into a single
+# multiline regex that also picks out START and STOP lines, so a whole batch
+# of lines is parsed by one findall().
+class LineSchema:
+    Roles = ('time', 'qenc', 'vel')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.fields = []
+        for token in spec.split():
+            key, sep, role = token.partition('=')
+            if sep == '' or key == '' or role.rstrip('?') == '':
+                raise ValueError('bad field %s in sample format %s' % (token, spec))
+            self.fields.append((key, role.rstrip('?'), role.endswith('?')))
+        roles = [field[1] for field in self.fields]
+        for role in self.Roles:
+            if role not in roles:
+                raise ValueError('sample format %s has no %s field' % (spec, role))
+        self.extras = [role for role in roles if role not in self.Roles]
+
+        # group 1 is START/STOP, fields follow in order
+        self.groups = dict((role, index + 1) for index, role in enumerate(roles))
+        body = ''
+        for index, (key, role, optional) in enumerate(self.fields):
+            field = r'(?<!\w)%s=(-?[0-9]+)' % re.escape(key)
+            if index > 0:
+                field = r'[^\n]*?' + field
+            body = body + ('(?:%s)?' % field if optional else field)
+        self.regex = re.compile(r'^[ \t]*(?:(START|STOP)[ \t\r]*$|%s)' % body, re.M)
+
+    # list of ('START' or 'STOP', None) and (None, columns) in line order, where
+    # columns maps each role to the list of its integer values
+    def Parse(self, text):
+        rows = self.regex.findall(text)
+        if len(rows) == 0:
+            return []
+        if 'START' not in text and 'STOP' not in text:
+            return [(None, self.columns(rows))]
+        events, first = [], 0
+        for index, row in enumerate(rows):
+            if row[0] != '':
+                if index > first:
+                    events.append((None, self.columns(rows[first:index])))
+                events.append((row[0], None))
+                first = index + 1
+        if first < len(rows):
+            events.append((None, self.columns(rows[first:])))
+        return events
+
+    def columns(self, rows):
+        values = zip(*rows)
+        columns = {}
+        for key, role, optional in self.fields:
+            column = values[self.groups[role]]
+            if optional:
+                columns[role] = [int(x) if x != '' else 0 for x in column]
+            else:
+                columns[role] = map(int, column)
+        return columns
+
+SampleFormat = 'T=time Q=qenc vel=vel'
 
-    def PollThreadFunc(self):
-        while self.Open:
-            if self.Enabled:
-                pygame.event.post(pygame.event.Event(SERIALEVENT))
-            sleep(0.01)
-   
 class DataProtocol:
-    samples = [None] * 0
+    store = None
     ranges = [[0,0]] * 3
     crossings = []
-    regex = re.compile(r'T=(?P<time>[\-0-9]+) Q=(?P<qenc>[\-0-9]+).*vel=(?P<vel>[\-0-9]+)')
+    crossindex = None
+    schema = None
+    # VelocityFilter spec applied to new runs, VelocityMovingAverage is the
+    # old two tap average and stands for 'ema:0.5'
+    VelocityFilterSpec = ''
     VelocityMovingAverage = False
     OnChange = None
+    # band around the setpoint a run has settled in, as a fraction of the step
+    SettlingBand = 0.02
+    # finished runs kept as PastRun, oldest first
+    HistoryRuns = 9
+    HistoryBudget = 64 * 1024 * 1024
+    history = None
+    # CaptureWriter the session is recorded to, if any
+    Recorder = None
+    # RunExporter every stopped run is exported with, as ExportName-runN
+    Exporter = None
+    ExportName = 'run'
+    # runs started so far and whether the current one has been stopped
+    runs = 0
+    finished = False
+    # Strip chart for streams without START: only the last StripSamples
+    # samples or StripSeconds seconds are shown and the y axes follow them.
+    # Older samples are forgotten once they outnumber the ones in view.
+    StripSamples = 0
+    StripSeconds = 0
+
+    def __init__(self, schema=None):
+        self.schema = schema if schema != None else LineSchema(SampleFormat)
+        self.extras = dict((role, array('l')) for role in self.schema.extras)
+        self.store = SampleStore()
+        self.crossings = []
+        self.crossingsCount = 0
+        self.crossindex = CrossingIndex(self.store.qenc)
+        # level of detail pyramids for rendering, indexed like Samples()
+        self.pyramids = [None, self.crossindex.pyramid, MinMaxPyramid(self.store.vel)]
+        self.history = deque()
+        # qsums[i] is the sum of the first i positions
+        self.qsums = array('d', [0.0])
+        self.metrics = None
+        self.metricsCount = -1
+        self.snapshot = None
+        self.ranges = [[100500,-100500], [100500,-100500], [100500,-100500]]
+        # samples forgotten by the strip chart, the index of the first one in
+        # view and the range of each trace in view
+        self.forgotten = 0
+        self.stripStart = 0
+        self.sliding = [None, SlidingRange(), SlidingRange()]
+        spec = self.VelocityFilterSpec
+        if spec == '' and self.VelocityMovingAverage:
+            spec = 'ema:0.5'
+        self.filter = VelocityFilter(spec)
 
     def ProcessData(self, line):
-        line = line.strip()
-        if line == 'STOP':
-            self.Finish()
-            return
-        if line == 'START':
-            self.Start()
-            return
-        m = self.regex.match(line)
-        if m != None:
-            time = int(m.group('time'))
-            qenc = int(m.group('qenc'))
-            vel = int(m.group('vel'))
-
-            self.Sample((time, qenc, vel))
+        self.ProcessLines([line.strip()])
+
+    # parse a batch of stripped lines in one pass; a recording gets the lines
+    # before a START or STOP ahead of it, so they land in the right run
+    def ProcessLines(self, lines):
+        # lines up to recorded are recorded, control lines up to searched found
+        recorded, searched = 0, 0
+        for control, columns in self.schema.Parse('\n'.join(lines)):
+            if control != None and self.Recorder != None:
+                marker = searched
+                while marker < len(lines) and lines[marker].strip() != control:
+                    marker = marker + 1
+                self.Recorder.Lines(lines[recorded:marker])
+                recorded, searched = marker, marker + 1
+            if control == 'STOP':
+                self.Finish()
+            elif control == 'START':
+                self.Start()
+            else:
+                for role in self.schema.extras:
+                    self.extras[role].extend(columns[role])
+                times, qencs, periods = columns['time'], columns['qenc'], columns['vel']
+                if len(times) == 1:
+                    self.Sample((times[0], qencs[0], periods[0]))
+                else:
+                    self.SampleBatch(times, qencs, periods)
+        if self.Recorder != None:
+            self.Recorder.Lines(lines[recorded:])
+
+    # decode a batch of binary records column-wise
+    def ProcessRecords(self, records):
+        values = array('i', ''.join(records.payloads))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        fields = len(RecordLayout)
+        columns = dict((role, values[index::fields]) for index, role in enumerate(RecordLayout))
+        for role in self.schema.extras:
+            self.extras[role].extend(array('l', [0]) * len(values[::fields]))
+        self.SampleBatch(columns['time'], columns['qenc'], columns['vel'])
 
     def Start(self):
-        self.samples = [None] * 0
+        if self.store.count > 1:
+            self.archive()
+        self.snapshot = None
+        self.store.Clear()
+        self.crossings = []
+        self.crossingsCount = 0
+        self.crossindex.Clear()
+        self.pyramids[2].Clear()
+        self.filter.Reset()
+        del self.qsums[1:]
+        self.metricsCount = -1
+        for role in self.extras:
+            del self.extras[role][:]
         self.ranges = [[100500,-100500], [100500,-100500], [100500,-100500]]
+        self.forgotten = 0
+        self.stripStart = 0
+        for window in self.sliding[1:]:
+            window.Clear()
+        self.runs = self.runs + 1
+        self.finished = False
+        if self.Recorder != None: self.Recorder.Start()
         if self.OnChange != None: self.OnChange()
 
+    # move the current run to history, forgetting the oldest runs beyond
+    # HistoryRuns or HistoryBudget bytes
+    def archive(self):
+        self.history.append(self.Snapshot())
+        while len(self.history) > self.HistoryRuns or \
+                sum(run.Size() for run in self.history) > self.HistoryBudget:
+            self.history.popleft()
+
+    # PastRun copy of the current run, shared by exports and the history
+    # while no samples come in; None before the first sample
+    def Snapshot(self):
+        if self.store.count == 0:
+            return None
+        if self.snapshot == None or self.snapshot.count != self.store.count:
+            count = self.store.count
+            ranges = [None] + [self.pyramids[index].Range(0, count) for index in (1, 2)]
+            self.snapshot = PastRun(self.runs, self.store, ranges)
+        return self.snapshot
+
     def Finish(self):
-        pass
+        self.finished = True
+        if self.Recorder != None: self.Recorder.Stop()
+        if self.Exporter != None and self.store.count > 0:
+            self.Exporter.Export(self.Snapshot(), self.ExportName)
+        if self.OnChange != None: self.OnChange()
 
     def Sample(self, samp):
-        # recalculate velocity into proper bananas
-        v = 2000.0/samp[2] if samp[2] != 0 else 2000.0
+        if self.Recorder != None: self.Recorder.Samples([samp[0]], [samp[1]], [samp[2]])
 
-        if self.VelocityMovingAverage:
-            if len(self.samples) > 0:
-                v = (self.samples[-1][2] + v) / 2
+        # recalculate velocity into proper bananas
+        raw = 2000.0/samp[2] if samp[2] != 0 else 2000.0
+        v = self.filter.Step(raw)
     
         # store sample: time (/10.0 for milliseconds), encoder value
         s = (samp[0]/10.0, samp[1], v)
-        self.samples.append(s)
+        self.store.Append(s[0], s[1], s[2], raw)
+        self.qsums.append(self.qsums[-1] + s[1])
+        self.crossindex.Append(s[1])
+        self.pyramids[2].Append(s[2])
         for index in [1,2]:
             if s[index] < self.ranges[index][0]:
                 self.ranges[index][0] = s[index]
             if s[index] > self.ranges[index][1]:
                 self.ranges[index][1] = s[index]
+        if self.Strip():
+            self.slide(self.store.count - 1)
 
-        self.updateZeroCrossings()
+        if self.OnChange != None: self.OnChange()
+
+    # Sample() for columns of raw time, encoder and period values at once
+    def SampleBatch(self, times, qencs, periods):
+        if self.Recorder != None: self.Recorder.Samples(times, qencs, periods)
+        raws = [2000.0/p if p != 0 else 2000.0 for p in periods]
+        vels = map(self.filter.Step, raws) if len(self.filter.filters) > 0 else raws
+        self.store.Extend([t/10.0 for t in times], qencs, vels, raws)
+        total, qsums = self.qsums[-1], self.qsums
+        for q in qencs:
+            total = total + q
+            qsums.append(total)
+        self.crossindex.Extend(self.store.count)
+        self.pyramids[2].Extend(self.store.count)
+        for index, column in ((1, qencs), (2, vels)):
+            self.ranges[index][0] = min(self.ranges[index][0], min(column))
+            self.ranges[index][1] = max(self.ranges[index][1], max(column))
+        if self.Strip():
+            self.slide(self.store.count - len(times))
 
         if self.OnChange != None: self.OnChange()
 
-    def updateZeroCrossings(self):
-        y = self.samples[-1][1]
-        prev = self.samples[0]
+    def Strip(self):
+        return self.StripSamples > 0 or self.StripSeconds > 0
+
+    # (first, last) time the strip chart shows, None if not a strip chart
+    def StripWindow(self):
+        count = self.store.count
+        if not self.Strip() or count == 0:
+            return None
+        last = self.store.time[count - 1]
+        if self.StripSeconds > 0:
+            return (last - 1000.0 * self.StripSeconds, last)
+        return (self.store.time[self.stripStart], last)
+
+    # Move the strip chart on after the samples from new were added: the
+    # new samples go into the sliding ranges, those out of view leave them.
+    # When more samples are out of view than in it they are forgotten and
+    # the indices are built again over the rest, which costs O(1) amortized
+    # per sample and keeps at most twice the samples in view.
+    def slide(self, new):
+        store, count = self.store, self.store.count
+        for index in [1,2]:
+            window = self.sliding[index]
+            for number, value in enumerate(islice(store.columns[index], new, count), self.forgotten + new):
+                window.Push(number, value)
+        first = 0
+        if self.StripSamples > 0:
+            first = max(first, count - self.StripSamples)
+        if self.StripSeconds > 0:
+            cutoff = store.time[count - 1] - 1000.0 * self.StripSeconds
+            first = max(first, bisect_left(store.time, cutoff, 0, count))
+        self.stripStart = first
+        for index in [1,2]:
+            self.sliding[index].Expire(self.forgotten + first)
+            self.ranges[index] = self.sliding[index].Range()
+        if first > count - first:
+            self.forget(first)
+
+    def forget(self, first):
+        self.store.Forget(first)
+        for role in self.extras:
+            del self.extras[role][:first]
+        count = self.store.count
+        self.forgotten = self.forgotten + first
+        self.stripStart = 0
+        self.crossindex.Clear()
+        self.crossindex.Extend(count)
+        self.pyramids[2].Clear()
+        self.pyramids[2].Extend(count)
+        offset = self.qsums[first]
+        self.qsums = array('d', [total - offset for total in islice(self.qsums, first, None)])
         self.crossings = []
-        for s in self.samples[1:-1]:            
-            if ((prev[1] < y) and (s[1] >= y)) or ((prev[1] >= y) and (s[1] < y)):
-                k = (s[1] - prev[1])/(s[0] - prev[0])
-                x = (y - prev[1])/k + prev[0]
-                self.crossings.append((x,y))
-            prev = s
-
-
-    def chunks(self, l, n):
-        for i in xrange(0, len(l), n):
-            yield l[i:i+n]
-
-    def decimate(self, data, factor):
-        r = []
-        for x in self.chunks(data, factor):
-            t = x[0][0]
-            s = sum([s[2] for s in x])
-            r.append((t, 1.0 * s / factor))
-        return r
+        self.crossingsCount = 0
+        self.metricsCount = -1
+        self.snapshot = None
+
+    # Switch the velocity filter to a VelocityFilter spec. The current run is
+    # filtered again from its raw velocities in one pass and its velocity
+    # pyramid rebuilt; runs in the history keep the filter they were shown with.
+    def SetVelocityFilter(self, spec):
+        self.filter = VelocityFilter(spec)
+        self.snapshot = None
+        store, count = self.store, self.store.count
+        if count > 0:
+            store.vel[:count] = array('d', self.filter.Apply(store.raw[:count]))
+            self.pyramids[2].Clear()
+            self.pyramids[2].Extend(count)
+            vels = store.vel[:count]
+            self.ranges[2] = [min(vels), max(vels)]
+            if self.Strip():
+                for window in self.sliding[1:]:
+                    window.Clear()
+                self.slide(0)
+        if self.OnChange != None: self.OnChange()
+
+    # crossings of the setpoint (last position), brought up to date on demand
+    def Crossings(self):
+        if self.crossingsCount != self.store.count:
+            self.updateZeroCrossings()
+        return self.crossings
+
+    # crossings of the setpoint by all but the last segment
+    def updateZeroCrossings(self):
+        count = self.store.count
+        self.crossingsCount = count
+        if count == 0:
+            self.crossings = []
+            return
+        times, qencs = self.store.time, self.store.qenc
+        y = qencs[count - 1]
+        segments = self.crossindex.Update(y, count - 1)
+        if len(self.crossings) > len(segments) or \
+                (len(self.crossings) > 0 and self.crossings[0][1] != y):
+            self.crossings = []
+        for i in segments[len(self.crossings):]:
+            dt = times[i + 1] - times[i]
+            if dt == 0:
+                x = times[i]
+            else:
+                k = (qencs[i + 1] - qencs[i])/dt
+                x = (y - qencs[i])/k + times[i]
+            self.crossings.append((x,y))
+
+
+    # Step response of the run so far against the setpoint, which is the
+    # setpoint column if the sample format has one and the last position
+    # otherwise: rise time from 10% to 90% of the step, overshoot in % of it,
+    # settling time into SettlingBand, steady-state error after settling and
+    # oscillation period from the crossings. Ingest only keeps prefix sums,
+    # each figure then takes O(log n) pyramid descents or O(1) sums and is
+    # brought up to date on demand. Figures that cannot be told yet are None.
+    def Metrics(self):
+        count = self.store.count
+        if self.metricsCount != count:
+            self.metricsCount = count
+            self.metrics = self.stepMetrics()
+        return self.metrics
+
+    def stepMetrics(self):
+        count = self.store.count
+        metrics = OrderedDict((name, None) for name in ('rise', 'overshoot', 'settling', 'error', 'period'))
+        if count < 2:
+            return metrics
+        times, qencs = self.store.time, self.store.qenc
+        pyramid = self.crossindex.pyramid
+        start = qencs[0]
+        target = self.extras['setpoint'][count - 1] if 'setpoint' in self.extras else qencs[count - 1]
+        step = target - start
+
+        crossings = self.Crossings()
+        if len(crossings) > 1:
+            # two crossings per period
+            metrics['period'] = 2 * (crossings[-1][0] - crossings[0][0]) / (len(crossings) - 1)
+        if step == 0:
+            return metrics
+
+        if step > 0:
+            reached = lambda level: pyramid.Find(lambda lo, hi: hi >= level)
+            peak = self.ranges[1][1]
+        else:
+            reached = lambda level: pyramid.Find(lambda lo, hi: lo <= level)
+            peak = self.ranges[1][0]
+        low, high = reached(start + 0.1 * step), reached(start + 0.9 * step)
+        if low >= 0 and high >= 0:
+            metrics['rise'] = times[high] - times[low]
+        metrics['overshoot'] = max(0.0, 100.0 * (peak - target) / step)
+
+        band = abs(step) * self.SettlingBand
+        outside = pyramid.Find(lambda lo, hi: lo < target - band or hi > target + band, True)
+        if outside < count - 1:
+            settled = outside + 1
+            metrics['settling'] = times[settled] - times[0]
+            metrics['error'] = target - (self.qsums[count] - self.qsums[settled]) / (count - settled)
+        return metrics
+
+    # Min/max envelope of a trace over equal time slices of [start, stop],
+    # one (slice, (min, max)) pair per slice from first on that holds any
+    # samples. Unlike averaging this keeps every peak visible at any zoom.
+    def Envelope(self, index, start, stop, slices, first=0):
+        times, count = self.store.time, self.store.count
+        pyramid = self.pyramids[index]
+        width = (stop - start) / float(slices)
+        envelope = []
+        lo = bisect_left(times, start + first * width, 0, count)
+        for column in xrange(first, slices):
+            if column == slices - 1:
+                hi = bisect_right(times, stop, lo, count)
+            else:
+                hi = bisect_left(times, start + (column + 1) * width, lo, count)
+            if hi > lo:
+                envelope.append((column, pyramid.Range(lo, hi)))
+            lo = hi
+        return envelope
 
     def Samples(self, index):
-        return [(x[0], x[index]) for x in self.samples] # position
+        return self.store.View(index)
 
     def XSamples(self, index):
-        for s in self.samples:
-            yield (s[0], s[index])
+        return iter(self.store.View(index))
 
     def Count(self):
-        return len(self.samples)
+        return self.store.count
 
     def Range(self, index):
         return self.ranges[index]
 
+    # indices [lo, hi) of the samples from start to stop, with one more on
+    # either side when there is one, so a trace can run to the edges
+    def TimeSpan(self, start, stop):
+        count, times = self.store.count, self.store.time
+        lo = max(bisect_left(times, start, 0, count) - 1, 0)
+        hi = min(bisect_right(times, stop, 0, count) + 1, count)
+        return lo, hi
+
     # find the nearest sample for specified time
     def SearchTime(self, time):
-        first = 0
-        last = len(self.samples)-1
-        nearest = -1
-        neardist = 100500
-
-        while first <= last:
-            midpoint = (first + last) // 2
-            dist = abs(self.samples[midpoint][0] - time)
-            if dist < neardist:
-                neardist = dist
-                nearest = midpoint
-
-            if time < self.samples[midpoint][0]:
-                last = midpoint - 1
-            else:
-                first = midpoint + 1
-        if nearest != -1:
-            return nearest, neardist, self.samples[nearest]
-        else:
+        count = self.store.count
+        if count == 0:
             return -1, -1, None
-
-
+        times = self.store.time
+        nearest = bisect_left(times, time, 0, count)
+        if nearest == count or \
+                (nearest > 0 and time - times[nearest - 1] <= times[nearest] - time):
+            nearest = nearest - 1
+        return nearest, abs(times[nearest] - time), self.store.At(nearest)
+
+
+# The graph is painted in three layers: traces are drawn on a trace layer,
+# appending only new segments while the axes stay put; crossings, setpoint and
+# other labels go on a data layer made from it whenever the data changes; the
+# mouse cursor and point of interest are composited on top of that per frame.
+# Past runs picked for overlay are aligned on the start of the current run
+# and drawn beneath it from layers of their own, each rendered once per scale.
 class Graph:
     surface = None
     plotsurface = None
+    layer = None
+    plotlayer = None
+    tracelayer = None
+    plottracelayer = None
     rect = None
     dirty = True
+    overlaydirty = True
     data = None
     scaler = [lambda x: x, lambda x: x, lambda x: x]
     invscaler = [lambda x: x, lambda x: x, lambda x: x]
+    # (tmin, tmax, ymin, ymax) and trace mode each plot is drawn with, and how
+    # many samples are already on the trace layer
+    axes = [None, None, None]
+    modes = [None, None, None]
+    drawn = 0
+    drawnrun = 0
+    # numbers of past runs picked for overlay, the last OverlayLast runs are
+    # overlaid as well; run layers are kept by run number with their axes
+    overlay = None
+    OverlayLast = 0
+    drawnoverlay = ()
+    drawnforgotten = 0
+    runlayers = None
+    # time window (tmin, tmax) while zoomed or panned, None to fit the run,
+    # and (mouse x, window) where a drag started
+    view = None
+    panning = None
+    ZoomStep = 0.8
     mouseX, mouseY = 0, 0
     POI = None
+    # how near in pixels the mouse has to be to a sample to point at it
+    POIRadius = 6
+    # pyramid blocks a POI lookup visits before it scans the samples instead
+    POISteps = 256
     plotlabels = []
+    # setpoint as (screen y, value) and y axis as (ymax, yscale) of the
+    # position plot, saved for the overlay when the data layer is painted
+    setpoint = None
+    yaxis = None
 
     def __init__(self, dimension, dataprovider):
         self.Resize(dimension)
         self.data = dataprovider
         self.data.OnChange = self.DataChanged
+        self.overlay = set()
+        self.runlayers = {}
 
     def DataChanged(self):
         self.POI = None
@@ -284,115 +2037,398 @@ class Graph:
 
     def Resize(self, dimension):
         self.rect = pygame.Rect((40, 0), (dimension[0] - 60, dimension[1] - 20))
+        self.tracelayer = pygame.Surface(dimension)
+        self.plottracelayer = self.tracelayer.subsurface(self.rect)
+        self.layer = pygame.Surface(dimension)
+        self.plotlayer = self.layer.subsurface(self.rect)
         self.surface = pygame.Surface(dimension)
         self.plotsurface = self.surface.subsurface(self.rect)
+        # each graph scales and draws its own plots
+        self.scaler = [lambda x: x, lambda x: x, lambda x: x]
+        self.invscaler = [lambda x: x, lambda x: x, lambda x: x]
+        self.axes = [None, None, None]
+        self.modes = [None, None, None]
         self.dirty = True
 
+    # The sample of either trace nearest to the mouse on screen, if it is
+    # within POIRadius pixels. The min/max pyramids of the traces serve as a
+    # spatial index: a block of samples spans the times of its first and last
+    # sample and its min to max value, scaled to a box on screen.
     def searchPOI(self):
-        position = self.invscaler[1]((self.mouseX, self.mouseY))
-        velocity = self.invscaler[2]((self.mouseX, self.mouseY))
-        index, dist, point = self.data.SearchTime(position[0])
-        if index != -1:
-            dist = lambda x1, y1, x2, y2: sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
-
-            dp = dist(position[0], position[1], point[0], point[1])
-            dv = dist(velocity[0], velocity[1], point[0], point[2])
-
-            if (dp <= 6) or (dv <= 6):
-                if dv < dp:
-                    self.POI = (2, index, point[0], point[2])
-                else:
-                    self.POI = (1, index, point[0], point[1])
-            else:
-                self.POI = None
+        self.POI = None
+        if self.data.Count() == 0:
+            return
+        mx, my = self.mouseX, self.mouseY
+        nearest = self.POIRadius
+        for plotIndex in [1, 2]:
+            scaler = self.scaler[plotIndex]
+            data = self.data.Samples(plotIndex)
+            def bound(first, last, lo, hi):
+                x0, y0 = scaler((data[first][0], lo))
+                x1, y1 = scaler((data[last - 1][0], hi))
+                dx = max(min(x0, x1) - mx, mx - max(x0, x1), 0)
+                dy = max(min(y0, y1) - my, my - max(y0, y1), 0)
+                return sqrt(dx * dx + dy * dy)
+            found = self.data.pyramids[plotIndex].Nearest(bound, nearest, self.POISteps)
+            if found == None:
+                found = self.scanPOI(plotIndex, nearest)
+            index, distance = found
+            if index != -1:
+                nearest = distance
+                self.POI = (plotIndex, index, data[index][0], data[index][1])
+
+    # Nearest sample within limit pixels by looking at all that are so close
+    # in x. Used where the boxes of the pyramid hold little, like a trace that
+    # jumps between two values at every sample, with the mouse in between.
+    def scanPOI(self, plotIndex, limit):
+        mx, my = self.mouseX, self.mouseY
+        scaler, invscaler = self.scaler[plotIndex], self.invscaler[plotIndex]
+        (t0, v0), (t1, v1) = invscaler((mx - limit, my - limit)), invscaler((mx + limit, my + limit))
+        vmin, vmax = min(v0, v1), max(v0, v1)
+        lo, hi = self.data.TimeSpan(min(t0, t1), max(t0, t1))
+        found = (-1, None)
+        values = self.data.store.columns[plotIndex]
+        for index, value in enumerate(islice(values, lo, hi), lo):
+            if value < vmin or value > vmax:
+                continue
+            x, y = scaler((self.data.store.time[index], value))
+            distance = sqrt((x - mx) ** 2 + (y - my) ** 2)
+            if distance <= limit:
+                limit = distance
+                found = (index, distance)
+        return found
+
+    # toggle overlay of the k-th most recent past run, 0 clears the overlay
+    def ToggleOverlay(self, k):
+        history = self.data.history
+        if k == 0:
+            self.overlay = set()
+            self.OverlayLast = 0
+        elif k <= len(history):
+            self.overlay.symmetric_difference_update([history[-k].number])
+        self.dirty = True
+
+    def overlayRuns(self):
+        history = list(self.data.history)
+        recent = history[-self.OverlayLast:] if self.OverlayLast > 0 else []
+        return [run for run in history if run.number in self.overlay or run in recent]
+
+    # zoom the time axis in (factor < 1) or out around the mouse position;
+    # zooming out past the whole run goes back to fitting it
+    def Zoom(self, pos, factor):
+        if self.axes[1] == None or self.data.Count() < 2 or (self.view == None and factor > 1):
+            return
+        tmin, tmax = self.view if self.view != None else self.axes[1][:2]
+        x = min(max(pos[0] - self.rect.left, 0), self.rect.width)
+        t = tmin + (tmax - tmin) * x / float(self.rect.width)
+        samples = self.data.Samples(1)
+        if factor > 1 and (tmax - tmin) * factor >= samples[-1][0] - samples[0][0]:
+            self.view = None
+        elif (tmax - tmin) * factor > 0.01:
+            self.view = (t - (t - tmin) * factor, t + (tmax - t) * factor)
+        self.dirty = True
+
+    def StartPan(self, pos):
+        if self.axes[1] != None:
+            self.panning = (pos[0], self.view if self.view != None else self.axes[1][:2])
+
+    def Pan(self, pos):
+        if self.panning == None:
+            return
+        x, (tmin, tmax) = self.panning
+        dt = (pos[0] - x) * (tmax - tmin) / float(self.rect.width)
+        self.view = (tmin - dt, tmax - dt)
+        self.dirty = True
+
+    def EndPan(self):
+        self.panning = None
+
+    def ResetView(self):
+        self.view = None
+        self.dirty = True
+
+    # filter the velocity of the run again and fit its axis anew
+    def SetVelocityFilter(self, spec):
+        self.data.SetVelocityFilter(spec)
+        self.axes[2] = None
+        self.dirty = True
+
+    # switch to the next of VelocityFilters
+    def CycleVelocityFilter(self):
+        spec = self.data.filter.spec
+        index = VelocityFilters.index(spec) if spec in VelocityFilters else -1
+        self.SetVelocityFilter(VelocityFilters[(index + 1) % len(VelocityFilters)])
 
     def MouseMove(self, pos):
         self.mouseX, self.mouseY = pos[0] - self.rect.left, pos[1] - self.rect.top
         self.searchPOI()
-        self.dirty = True
+        self.overlaydirty = True
 
-    def plot(self, data, yrange, LineColor, NodeColor, plotIndex, crossings=[]):
+    # Axes for a plot: the current ones while the data still fits in them,
+    # otherwise new ones with headroom while the run streams or an exact fit
+    # once it is stopped. Returns the axes and whether they changed.
+    def fitAxis(self, plotIndex, tmin, tmax, yrange):
         ymin, ymax = yrange
-        line = pygame.draw.line
-        circle = pygame.draw.circle
-        rotate = pygame.transform.rotate
+        axis = self.axes[plotIndex]
+        if axis != None and axis[0] == tmin and tmax <= axis[1] and \
+                axis[2] <= ymin and ymax <= axis[3]:
+            if not self.data.finished or axis == (tmin, tmax, ymin, ymax):
+                return axis, False
+        if not self.data.finished:
+            margin = (ymax - ymin) * RangeHysteresis
+            axis = (tmin, tmin + (tmax - tmin) * TimeHeadroom, ymin - margin, ymax + margin)
+        else:
+            axis = (tmin, tmax, ymin, ymax)
+        return axis, True
+
+    # create mappings: plot to screen (scaler) and screen to plot (invscaler)
+    def setScale(self, plotIndex, axis):
+        tmin, tmax, ymin, ymax = axis
         width, height = self.rect.width, self.rect.height
 
-        # create mappings: plot to screen (scaler) and screen to plot (invscaler)
         swing = abs(ymax - ymin)
-        xscale, yscale = (1.0 * width / (data[-1][0] - data[0][0]), 
+        xscale, yscale = (1.0 * width / (tmax - tmin) if tmax > tmin else 1,
                           1.0 * height / swing if swing > 0.1 else 1)
         
-        offset = (data[0][0], ymin + (ymax-ymin)/2)
+        offset = (tmin, ymin + (ymax-ymin)/2)
         self.scaler[plotIndex] = lambda samp: \
             ((samp[0]-offset[0]) * xscale, height/2 - (samp[1]-offset[1]) * yscale)
         self.invscaler[plotIndex] = lambda samp: \
             (samp[0] / xscale + offset[0], ymax - samp[1]/yscale)
+        if plotIndex == 1:
+            self.yaxis = (ymax, yscale)
+        self.axes[plotIndex] = axis
+
+    # how a trace is drawn depends on how many samples of data[lo:hi] share
+    # a pixel column
+    def traceMode(self, data, axis, lo, hi):
+        tmin, tmax = axis[0], axis[1]
+        if hi - lo < 2:
+            return 'nodes'
+        first, last = max(data[lo][0], tmin), min(data[hi - 1][0], tmax)
+        used = self.rect.width * (last - first) / (tmax - tmin) if tmax > tmin else 1
+        density = (hi - lo) / max(used, 1.0)
+        if density > EnvelopeDensity:
+            return 'envelope'
+        if density <= NodeDensity:
+            return 'nodes'
+        return 'lines'
+
+    # draw the trace of samples first to stop over what is already drawn
+    def plotTrace(self, data, plotIndex, first, stop, LineColor, NodeColor):
+        circle = pygame.draw.circle
+        width = self.rect.width
         scaler = self.scaler[plotIndex]
 
-        end = scaler(data[-1])
-
-        if plotIndex == 1:            
-            # draw middle line (servo setpoint)
-            line(self.plotsurface, MarkerColor, (0, end[1]), (width-1, end[1]))
-
-            # Check zero crossing and draw a marker and a label if there is one
-            for cross in crossings:
-                xy = scaler(cross)
-                line(self.plotsurface, MarkerColor, (xy[0], end[1]-5), (xy[0], end[1]+5))
-                label = rotate(
-                    Font.render('%4.1f' % cross[0], 0, TextMarkerColor, TextMarkerBgColor), 90)
-                labely = end[1] + (20 if end[1] < height/2 else - 20 - label.get_height())
-                #self.plotsurface.blit(label, (xy[0] - label.get_width()/2, labely))
-                self.plotlabels.append((label, (xy[0] - label.get_width()/2, labely)))
-
-
-            label = Font.render(str(ymin), 0, LineColor)
-            self.surface.blit(label, (2, height - label.get_height()))
+        xyses = []
+        if self.modes[plotIndex] == 'envelope':
+            # zigzag through per-column extremes, up on even columns and down
+            # on odd ones, so the outline and the spread are both drawn.
+            # Extremes only widen, so the last column is simply redrawn.
+            tmin, tmax = self.axes[plotIndex][0], self.axes[plotIndex][1]
+            column = min(max(int(scaler(data[first])[0]), 0), width - 1)
+            for column, (lo, hi) in self.data.Envelope(plotIndex, tmin, tmax, width, column):
+                ylo, yhi = scaler((0, lo))[1], scaler((0, hi))[1]
+                if column & 1:
+                    xyses.append((column, yhi))
+                    xyses.append((column, ylo))
+                else:
+                    xyses.append((column, ylo))
+                    xyses.append((column, yhi))
+        elif first < stop:
+            xyses = [scaler(xy) for xy in data[first:stop]]
+            if self.modes[plotIndex] == 'nodes':
+                for xy in xyses:
+                    circle(self.plottracelayer, NodeColor, [int(round(p)) for p in xy], 2, 1)
+        if len(xyses) > 1:
+            pygame.draw.lines(self.plottracelayer, LineColor, False, xyses, 1)
+
+    # trace of a past run started along with the current one, over the part
+    # of the current axes it covers, as a min/max envelope when it is denser
+    # than EnvelopeDensity samples per pixel column
+    def runTrace(self, run, plotIndex):
+        times, values = run.time, run.columns[plotIndex]
+        scaler = self.scaler[plotIndex]
+        # from the clock of the past run to that of the current one
+        start = self.data.Samples(1)[0][0] - run.start
+        tmin, tmax = self.axes[plotIndex][0], self.axes[plotIndex][1]
+        width = self.rect.width
+        first = max(bisect_left(times, tmin - start) - 1, 0)
+        last = min(bisect_right(times, tmax - start) + 1, run.count)
+        if last - first <= width * EnvelopeDensity or tmax <= tmin:
+            return [scaler((start + t, y)) for t, y in izip(times[first:last], values[first:last])]
+        step = (tmax - tmin) / float(width)
+        xyses, lo = [], first
+        for column in xrange(width):
+            hi = bisect_left(times, tmin - start + (column + 1) * step, lo) if column < width - 1 else last
+            if hi > lo:
+                ylo, yhi = scaler((0, min(values[lo:hi])))[1], scaler((0, max(values[lo:hi])))[1]
+                if column & 1:
+                    xyses.extend(((column, yhi), (column, ylo)))
+                else:
+                    xyses.extend(((column, ylo), (column, yhi)))
+            lo = hi
+            if lo == last:
+                break
+        return xyses
+
+    # both traces of a past run on a layer of its own, kept while the axes stay
+    def runLayer(self, run):
+        key = (self.axes[1], self.axes[2], self.rect.size)
+        cached = self.runlayers.get(run.number)
+        if cached != None and cached[0] == key:
+            return cached[1]
+        surface = pygame.Surface(self.rect.size)
+        surface.fill(BgColor)
+        surface.set_colorkey(BgColor)
+        for plotIndex, LineColor in ((1, OverlayPosColor), (2, OverlayVelColor)):
+            xyses = self.runTrace(run, plotIndex)
+            if len(xyses) > 1:
+                pygame.draw.lines(surface, LineColor, False, xyses, 1)
+        self.runlayers[run.number] = (key, surface)
+        return surface
+
+    # Bring the trace layer up to date: only the segments added since the last
+    # paint are drawn unless an axis, the trace mode or the overlay changed.
+    # Zoomed in, only the samples in view are drawn and the y axes fit them,
+    # found by bisecting the time column and from the min/max pyramids.
+    def paintTraces(self):
+        plots = [(1, PosLineColor, PosNodeColor), (2, VelLineColor, VelNodeColor)]
+        runs = self.overlayRuns()
+        overlay = tuple(run.number for run in runs)
+        full = self.drawn > self.data.Count() or self.drawnrun != self.data.runs or \
+            self.drawnoverlay != overlay or self.drawnforgotten != self.data.forgotten
+        strip = self.data.StripWindow() if self.view == None else None
+        view = self.view if strip == None else strip
+        lo, hi = (0, self.data.Count()) if view == None else self.data.TimeSpan(*view)
+        for plotIndex, LineColor, NodeColor in plots:
+            data = self.data.Samples(plotIndex)
+            if view == None:
+                tmin, tmax = data[0][0], data[-1][0]
+                ymin, ymax = self.data.Range(plotIndex)
+                for run in runs:
+                    tmax = max(tmax, tmin + run.Duration())
+                    ymin, ymax = min(ymin, run.ranges[plotIndex][0]), max(ymax, run.ranges[plotIndex][1])
+                axis, changed = self.fitAxis(plotIndex, tmin, tmax, (ymin, ymax))
+            else:
+                if strip != None or hi <= lo:
+                    ymin, ymax = self.data.Range(plotIndex)
+                else:
+                    ymin, ymax = self.data.pyramids[plotIndex].Range(lo, hi)
+                margin = (ymax - ymin) * RangeHysteresis
+                axis = (view[0], view[1], ymin - margin, ymax + margin)
+                changed = axis != self.axes[plotIndex]
+            mode = self.traceMode(data, axis, lo, hi)
+            if changed or mode != self.modes[plotIndex]:
+                full = True
+            self.setScale(plotIndex, axis)
+            self.modes[plotIndex] = mode
+
+        if full:
+            self.tracelayer.fill(BgColor)
+            pygame.draw.rect(self.tracelayer, PlotFrameColor, self.rect, 1)
+            self.drawn = 0
+            self.drawnrun = self.data.runs
+            self.drawnoverlay = overlay
+            self.drawnforgotten = self.data.forgotten
+            for number in self.runlayers.keys():
+                if number not in overlay:
+                    del self.runlayers[number]
+            for run in runs:
+                self.plottracelayer.blit(self.runLayer(run), (0, 0))
+
+        for plotIndex, LineColor, NodeColor in plots:
+            self.plotTrace(self.data.Samples(plotIndex), plotIndex, max(self.drawn - 1, lo), hi, LineColor, NodeColor)
+        self.drawn = self.data.Count()
+
+    # setpoint, crossings and axis labels of the position plot
+    def annotate(self, data, crossings):
+        line = pygame.draw.line
+        rotate = pygame.transform.rotate
+        width, height = self.rect.width, self.rect.height
+        scaler = self.scaler[1]
+        ymin, ymax = self.axes[1][2], self.axes[1][3]
 
-            label = Font.render(str(ymax), 0, LineColor)
-            self.surface.blit(label, (2, 0))
+        end = scaler(data[-1])
+        self.setpoint = (end[1], data[-1][1])
+
+        # draw middle line (servo setpoint)
+        line(self.plotlayer, MarkerColor, (0, end[1]), (width-1, end[1]))
+
+        # Check zero crossing and draw a marker and a label if there is one
+        for cross in crossings:
+            xy = scaler(cross)
+            line(self.plotlayer, MarkerColor, (xy[0], end[1]-5), (xy[0], end[1]+5))
+            label = rotate(
+                Font.render('%4.1f' % cross[0], 0, TextMarkerColor, TextMarkerBgColor), 90)
+            labely = end[1] + (20 if end[1] < height/2 else - 20 - label.get_height())
+            self.plotlabels.append((label, (xy[0] - label.get_width()/2, labely)))
+
+        label = Font.render('%3.1f' % ymin, 0, PosLineColor)
+        self.layer.blit(label, (2, height - label.get_height()))
+
+        label = Font.render('%3.1f' % ymax, 0, PosLineColor)
+        self.layer.blit(label, (2, 0))
+
+        # draw setpoint label
+        label = Font.render(str(data[-1][1]), 0, MarkerColor)
+        self.layer.blit(label, (self.rect.right + 2, end[1] - label.get_height()/2))
+
+        return end
+
+    # step response figures known so far
+    def figures(self):
+        metrics = self.data.Metrics()
+        formats = (('rise', 'Rise=%.1fms'), ('overshoot', 'Overshoot=%.1f%%'),
+            ('settling', 'Settling(%g%%%%)=%%.1fms' % (100 * self.data.SettlingBand)),
+            ('error', 'SSE=%.1f'), ('period', 'Period=%.1fms'))
+        if self.data.Strip():
+            # a strip chart shows no step, only the oscillation
+            formats = formats[-1:]
+        figures = [format % metrics[name] for name, format in formats if metrics[name] != None]
+        if self.data.filter.spec != '':
+            figures.append('Filter=%s' % self.data.filter.spec)
+        return figures
+
+    # cursor line, distance to setpoint and the point of interest
+    def paintOverlay(self):
+        line = pygame.draw.line
+        rotate = pygame.transform.rotate
+        width = self.rect.width
 
-            # draw setpoint label
-            label = Font.render(str(data[-1][1]), 0, MarkerColor)
-            self.surface.blit(label, (self.rect.right + 2, end[1] - label.get_height()/2))
-        
-            
-            if (self.mouseY >= 0) and (self.mouseY < self.plotsurface.get_height()): 
-                # draw horizontal line at mouse cursor    
-                line(self.plotsurface, MouseColor, (1, self.mouseY), (width - 1, self.mouseY))
-                # draw a label indicating position corresponding to mouse cursor
-                value = ymax - self.mouseY / yscale
-                label = Font.render('%3.1f' % (value), 0, MouseColor)
-                self.surface.blit(label, (2, self.mouseY - label.get_height()/2))
-                # draw vertical line that shows distance from mouse position to servo setpoint 
-                line(self.surface, MouseColor, 
-                    (self.rect.right + 5, self.mouseY), (self.rect.right + 5, end[1]))
-                # draw the distance from mouse to setpoint
-                label = rotate(Font.render('%d' % (value - data[-1][1]), 0, MouseColor), 90)
-                labely = (self.mouseY + end[1]) / 2;
-                self.surface.blit(label, (self.rect.right + 8, labely))
-
-        # Draw the actual plot
-        xyses = [scaler(xy) for xy in data]
-        pygame.draw.lines(self.plotsurface, LineColor, False, xyses, 1)
-        for xy in xyses:
-            circle(self.plotsurface, NodeColor, [int(round(p)) for p in xy], 2, 1)
-
-        if (self.POI != None) and (self.POI[0] == plotIndex):
-            index = self.POI[1]
-            point = scaler(data[index])
-            circle(self.plotsurface, HighlightNodeColor, [int(round(x)) for x in point], 4, 0)
-            label = Font.render('%4.1f, %4.1f' % (data[index][0], data[index][1]), 0, LocalLabelTextColor, LineColor)
+        if self.yaxis == None:
+            return
+        ymax, yscale = self.yaxis
+        endy, setpoint = self.setpoint
+
+        if (self.mouseY >= 0) and (self.mouseY < self.plotsurface.get_height()): 
+            # draw horizontal line at mouse cursor    
+            line(self.plotsurface, MouseColor, (1, self.mouseY), (width - 1, self.mouseY))
+            # draw a label indicating position corresponding to mouse cursor
+            value = ymax - self.mouseY / yscale
+            label = Font.render('%3.1f' % (value), 0, MouseColor)
+            self.surface.blit(label, (2, self.mouseY - label.get_height()/2))
+            # draw vertical line that shows distance from mouse position to servo setpoint 
+            line(self.surface, MouseColor, 
+                (self.rect.right + 5, self.mouseY), (self.rect.right + 5, endy))
+            # draw the distance from mouse to setpoint
+            label = rotate(Font.render('%d' % (value - setpoint), 0, MouseColor), 90)
+            labely = (self.mouseY + endy) / 2;
+            self.surface.blit(label, (self.rect.right + 8, labely))
+
+        if self.POI != None:
+            plotIndex, index, x, y = self.POI
+            LineColor = PosLineColor if plotIndex == 1 else VelLineColor
+            point = self.scaler[plotIndex]((x, y))
+            pygame.draw.circle(self.plotsurface, HighlightNodeColor, [int(round(p)) for p in point], 4, 0)
+            label = Font.render('%4.1f, %4.1f' % (x, y), 0, LocalLabelTextColor, LineColor)
 
             labelpos = [point[0] + 4, point[1] - label.get_height() - 4]
             if labelpos[0] + label.get_width() >= self.rect.right:
                 labelpos[0] = point[0] - label.get_width() - 4
             if labelpos[1] <= 0:
                 labelpos[1] = point[1] + 4
-            self.plotlabels.append((label, labelpos))
-
-        return end, crossings
+            self.plotsurface.blit(label, labelpos)
 
     def Paint(self):
         global BigFont, FontName, FontSize, BigFontSize, PlotFrameColor
@@ -401,50 +2437,84 @@ class Graph:
             if BigFont == None:
                 BigFont = pygame.font.SysFont(FontName, BigFontSize)
 
-            self.surface.fill(BgColor)
-
-            # labels to be post-blitted on self.plotsurface
+            # labels to be post-blitted on self.plotlayer
             self.plotlabels = []
+            self.yaxis = None
 
-            # Draw the plot frame
-            pygame.draw.rect(self.surface, PlotFrameColor, self.rect, 1)
             if self.data.Count() > 1:
+                self.paintTraces()
+                self.layer.blit(self.tracelayer, (0, 0))
+
                 # The main plot (position vs time)
                 samples = self.data.Samples(1)
-                end, crossings = self.plot(samples, self.data.Range(1), PosLineColor, PosNodeColor, 1, self.data.crossings)
-
-                # Secondary plot (velocity)
-                self.plot(self.data.Samples(2), self.data.Range(2), VelLineColor, VelNodeColor, 2)
+                crossings = self.data.Crossings()
+                end = self.annotate(samples, crossings)
 
                 # Draw start and end times 
-                label = Font.render('%3.1f' % (samples[0][0]), 1, PlotTextColor)
+                label = Font.render('%3.1f' % (self.axes[1][0]), 1, PlotTextColor)
                 labely = self.rect.bottom + 2
-                self.surface.blit(label, (self.rect.left - label.get_width()/2, labely))
-                label = Font.render('%3.1f' % (samples[-1][0]), 1, PlotTextColor)
-                self.surface.blit(label, (self.rect.right - label.get_width()/2, labely))
+                self.layer.blit(label, (self.rect.left - label.get_width()/2, labely))
+                label = Font.render('%3.1f' % (self.axes[1][1]), 1, PlotTextColor)
+                self.layer.blit(label, (self.rect.right - label.get_width()/2, labely))
 
-                # Draw totals
+                # Draw totals and the step response figures under them
+                figures = self.figures()
                 label = BigFont.render('Time=%4.1fms' % ((samples[-1][0] - samples[0][0])), 0, PlotTextColor)
-                labely = self.rect.height - label.get_height() * 4 if end[1] < self.rect.height/2 else label.get_height()
+                labely = self.rect.height - label.get_height() * 4 - len(figures) * Font.get_linesize() \
+                    if end[1] < self.rect.height/2 else label.get_height()
                 labelx = self.rect.width - label.get_width() - 20
-                self.surface.blit(label, (labelx, labely))
+                self.layer.blit(label, (labelx, labely))
                 labely = labely + label.get_height()
                 label = BigFont.render('Xings=%d' % (len(crossings)), 0, PlotTextColor)
-                self.surface.blit(label, (labelx, labely))
+                self.layer.blit(label, (labelx, labely))
+                labely = labely + label.get_height()
+                for figure in figures:
+                    label = Font.render(figure, 0, PlotTextColor)
+                    self.layer.blit(label, (labelx, labely))
+                    labely = labely + label.get_height()
+
+                # Name the overlaid runs
+                if len(self.drawnoverlay) > 0:
+                    label = Font.render('Runs %s under run %d' % (', '.join(str(number) for number in self.drawnoverlay),
+                        self.data.runs), 0, OverlayPosColor)
+                    self.plotlayer.blit(label, (4, 2))
 
                 # Draw plotlabels
                 for label in self.plotlabels:
-                    self.plotsurface.blit(label[0], label[1])
+                    self.plotlayer.blit(label[0], label[1])
+            else:
+                self.axes = [None, None, None]
+                self.drawn = 0
+                self.layer.fill(BgColor)
+                # Draw the plot frame
+                pygame.draw.rect(self.layer, PlotFrameColor, self.rect, 1)
 
             self.dirty = False
+            self.overlaydirty = True
+
+        if self.overlaydirty:
+            self.surface.blit(self.layer, (0, 0))
+            self.paintOverlay()
+            self.overlaydirty = False
 
         return self.surface
 
+# Text lines are drawn on textsurface which is kept between paints: when the
+# view moves by a few lines the old content is scrolled and only the newly
+# exposed lines are drawn. While the search prompt is open the view stays put
+# as new lines arrive.
 class TextWin:
     surface = None
+    textsurface = None
     rect = None
     skiplines = 0
     buffer = None
+    # bottom line number and scroll state textsurface was last painted for
+    painted = None
+    # search prompt text (None when closed), line found and whether it failed
+    query = None
+    found = None
+    notfound = False
     global FontName, FontSize
 
     def __init__(self, buf, dimension):
@@ -454,11 +2524,70 @@ class TextWin:
         self.skiplines = 0
 
     def BufferChanged(self):
-        self.skiplines = 0
+        if self.query != None:
+            self.skiplines = min(self.skiplines + 1, self.buffer.Count() - 1)
+        else:
+            self.skiplines = 0
 
     def Resize(self, dimension):
         self.rect = pygame.Rect((0, 0), dimension)
         self.surface = pygame.Surface(dimension)
+        self.textsurface = pygame.Surface(dimension)
+        self.painted = None
+
+    def Searching(self):
+        return self.query != None
+
+    def StartSearch(self):
+        self.query = ''
+        self.found = None
+        self.notfound = False
+
+    # Prompt keys: Return or Up finds the previous (older) match, Down the
+    # next one, Escape closes the prompt and follows the tail again.
+    def SearchKey(self, event):
+        if event.key == pygame.K_ESCAPE:
+            self.query, self.found = None, None
+            self.skiplines = 0
+        elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER, pygame.K_UP):
+            self.search(True)
+        elif event.key == pygame.K_DOWN:
+            self.search(False)
+        elif event.key == pygame.K_BACKSPACE:
+            self.query = self.query[:-1]
+            self.found = None
+        elif len(event.unicode) > 0 and event.unicode >= ' ':
+            self.query = self.query + event.unicode.encode('ascii', 'replace')
+            self.found = None
+
+    # search from the last match, or from the bottom of the view, and bring
+    # the matching line to the middle of the window
+    def search(self, backward):
+        if len(self.query) == 0:
+            return
+        try:
+            regex = re.compile(self.query, re.M)
+        except re.error:
+            regex = re.compile(re.escape(self.query), re.M)
+        start = self.found
+        if start == None:
+            start = self.buffer.Total() - self.skiplines - (0 if backward else 1)
+        found = self.buffer.Search(regex, start, backward)
+        self.notfound = found == None
+        if found != None:
+            self.found = found
+            rows = self.rect.height / LineHeight
+            skip = self.buffer.Total() - 1 - found - rows / 2
+            self.skiplines = min(max(skip, 0), self.buffer.Count() - 1)
+
+    # search prompt and a frame around the line found
+    def paintSearch(self, bottom):
+        if self.found != None and 0 <= bottom - self.found < self.rect.height / LineHeight:
+            y = self.rect.height - (bottom - self.found + 1) * LineHeight
+            pygame.draw.rect(self.surface, TextMarkerColor, (0, y, self.rect.width - 6, LineHeight), 1)
+        prompt = 'Search: %s%s' % (self.query, ' (not found)' if self.notfound else '')
+        label = Font.render(prompt, 1, TextMarkerColor, TextMarkerBgColor)
+        self.surface.blit(label, (self.rect.width - label.get_width() - 8, 0))
 
     def ScrollUp(self):
         if self.skiplines < self.buffer.Count() - 1:
@@ -476,143 +2605,907 @@ class TextWin:
         barY = self.rect.height - int(round(self.rect.height * 1.0 * offset / total))
         pygame.draw.line(self.surface, ScrollBarColor, (self.rect.right - 3, barY), (self.rect.right - 3, barY - barHeight), 3)
 
+    def renderLine(self, line):
+        return Font.render(line, 1, TextWinFgColor)
+
+    # draw text rows first..last-1, row 0 being at the bottom
+    def paintRows(self, bottom, first, last):
+        height = self.rect.height
+        self.textsurface.fill(TextWinBgColor,
+            (0, height - last * LineHeight, self.rect.width, (last - first) * LineHeight))
+        for row in xrange(first, last):
+            number = bottom - row
+            if number < self.buffer.First():
+                break
+            self.textsurface.blit(self.buffer.Surface(number, self.renderLine),
+                (0, height - (row + 1) * LineHeight))
+
     def Paint(self):
         global Font
         if Font == None:
             Font = pygame.font.SysFont(FontName, FontSize)
-        self.surface.fill(TextWinBgColor)
-
-        texty = self.rect.height - LineHeight
-        skippy = self.skiplines
-        visible = 0
-        for line in self.buffer.Enumerate():
-            if skippy > 0:
-                skippy = skippy - 1
-                continue
-            visible = visible + 1
-            garbage = Font.render(line, 1, TextWinFgColor)
-            self.surface.blit(garbage, (0, texty))
-            texty = texty - LineHeight
-            if texty < 0:
-                break
+
+        rows = self.rect.height / LineHeight
+        bottom = self.buffer.Total() - 1 - self.skiplines
+        state = (bottom, self.buffer.Count(), self.skiplines, self.query, self.found, self.notfound)
+        if state == self.painted:
+            return self.surface
+
+        shift = bottom - self.painted[0] if self.painted != None else rows
+        if abs(shift) >= rows:
+            self.textsurface.fill(TextWinBgColor)
+            self.paintRows(bottom, 0, rows)
+        elif shift != 0:
+            self.textsurface.scroll(0, -shift * LineHeight)
+            # rows only partly on screen at the top are never drawn
+            self.textsurface.fill(TextWinBgColor,
+                (0, 0, self.rect.width, self.rect.height - rows * LineHeight))
+            if shift > 0:
+                self.paintRows(bottom, 0, shift)
+            else:
+                self.paintRows(bottom, rows + shift, rows)
+        self.painted = state
+
+        visible = max(min(rows, bottom - self.buffer.First() + 1), 0)
+        self.surface.blit(self.textsurface, (0, 0))
         self.drawScrollbar(self.buffer.Count(), visible, self.skiplines)
+        if self.query != None:
+            self.paintSearch(bottom)
         return self.surface
 
+# End-to-end latency from line arrival to the flip that shows it,
+# summarized over Period seconds
+class LatencyMeter:
+    Period = 1.0
+
+    def __init__(self):
+        self.started = clocktime()
+        self.total, self.worst, self.count = 0.0, 0.0, 0
+        self.summary = (0.0, 0.0)
+
+    def Add(self, latency):
+        self.total = self.total + latency
+        self.worst = max(self.worst, latency)
+        self.count = self.count + 1
+
+    # whether a period is over; starts the next one if so
+    def Due(self):
+        now = clocktime()
+        if now - self.started < self.Period or self.count == 0:
+            return False
+        self.summary = (self.total / self.count, self.worst)
+        self.started = now
+        self.total, self.worst, self.count = 0.0, 0.0, 0
+        return True
+
+    def Report(self):
+        return 'latency %.1f ms avg, %.1f ms max' % (self.summary[0] * 1000, self.summary[1] * 1000)
+
+# Hot path counters of the UI loop summed over a period: bytes and lines
+# taken in, time spent per stage and frames painted, and the queues of all
+# sources at the end of it. Every period makes a row of figures, shown by the
+# HUD and appended to a CSV file, or JSON lines if the name ends in .json.
+class PerfMeter:
+    Period = 1.0
+    Stages = ('buffer', 'parse', 'crossings', 'graph', 'text')
+    Fields = ('time', 'bytes/s', 'lines/s', 'frames/s') + tuple('%s ms/frame' % stage for stage in Stages) + \
+        ('queued batches', 'queued lines', 'dropped')
+
+    def __init__(self, path=None):
+        self.origin = self.started = clocktime()
+        self.spent = dict((stage, 0.0) for stage in self.Stages)
+        self.lines, self.frames, self.received = 0, 0, 0
+        self.row = None
+        self.out = open(path, 'w') if path != None else None
+        self.json = path != None and path.lower().endswith('.json')
+        if self.out != None and not self.json:
+            self.out.write(','.join(self.Fields) + '\n')
+
+    def Add(self, stage, spent):
+        self.spent[stage] = self.spent[stage] + spent
+
+    def Lines(self, count):
+        self.lines = self.lines + count
+
+    def Frame(self):
+        self.frames = self.frames + 1
+
+    # whether a period is over; makes its row and starts the next one if so.
+    # final ends the last period early.
+    def Due(self, connections, final=False):
+        now = clocktime()
+        elapsed = now - self.started
+        if elapsed < self.Period and not (final and elapsed > 0):
+            return False
+        received = sum(connection.received for connection in connections)
+        backlogs = [connection.Backlog() for connection in connections]
+        frames = max(self.frames, 1)
+        self.row = OrderedDict(izip(self.Fields, [round(now - self.origin, 3),
+            (received - self.received) / elapsed, self.lines / elapsed, self.frames / elapsed] +
+            [1000 * self.spent[stage] / frames for stage in self.Stages] +
+            [sum(batches for batches, lines in backlogs), sum(lines for batches, lines in backlogs),
+             sum(connection.dropped for connection in connections)]))
+        if self.out != None:
+            if self.json:
+                self.out.write(json.dumps(self.row) + '\n')
+            else:
+                self.out.write(','.join('%g' % value for value in self.row.values()) + '\n')
+            self.out.flush()
+        self.started, self.received = now, received
+        self.lines, self.frames = 0, 0
+        for stage in self.Stages:
+            self.spent[stage] = 0.0
+        return True
+
+    # the last row as text lines for the HUD
+    def Report(self):
+        if self.row == None:
+            return ['measuring...']
+        row = self.row
+        report = ['%.1f kB/s  %.0f lines/s  %.0f fps' % (row['bytes/s'] / 1024, row['lines/s'], row['frames/s'])]
+        report.extend('%-10s %6.2f ms/frame' % (stage, row['%s ms/frame' % stage]) for stage in self.Stages)
+        report.append('queued %d batches, %d lines' % (row['queued batches'], row['queued lines']))
+        report.append('dropped %d lines' % row['dropped'])
+        return report
+
+    def Close(self):
+        if self.out != None:
+            self.out.close()
+
+# text lines in a box at the top right of the plot area
+def PaintHud(screen, report):
+    labels = [Font.render(text, 0, TextMarkerColor) for text in report]
+    width = max(label.get_width() for label in labels) + 8
+    rect = pygame.Rect(PlotRect().right - width - 24, PlotRect().top + LineHeight + 4, width, len(labels) * LineHeight + 6)
+    screen.fill(TextMarkerBgColor, rect)
+    for index, label in enumerate(labels):
+        screen.blit(label, (rect.left + 4, rect.top + 3 + index * LineHeight))
+
 def TextWinHeight():
     return Dimension[1] - SeparatorPosition
 
 def PlotRect():
-    return pygame.Rect(0, 5, Dimension[0], SeparatorPosition - 5)
+    return pygame.Rect(0, 5 + TabBarHeight, Dimension[0], SeparatorPosition - 5 - TabBarHeight)
+
+# plot area of each of count sources: the same for all with tabs, a row each
+# when stacked
+def ChannelRects(count):
+    rect = PlotRect()
+    if Layout == 'tabs' or count == 1:
+        return [rect] * count
+    height = rect.height / count
+    return [pygame.Rect(rect.left, rect.top + i * height, rect.width, height) for i in xrange(count)]
+
+# one tab per source along the top of the window
+def TabRects(channels):
+    rects, x = [], 0
+    for channel in channels:
+        width = Font.size(channel.name)[0] + 16
+        rects.append(pygame.Rect(x, 2, width, TabBarHeight))
+        x = x + width + 2
+    return rects
+
+# A source with a protocol, scrollback, plot and text window of its own
+class Channel:
+    def __init__(self, connection, name, size, record=None, exporter=None):
+        self.connection = connection
+        self.name = name
+        self.protocol = DataProtocol()
+        self.buffa = Buffer()
+        self.graph = Graph(size, self.protocol)
+        self.status = TextWin(self.buffa, (Dimension[0], TextWinHeight()))
+        self.recorder = CaptureWriter(record) if record != None else None
+        self.protocol.Recorder = self.recorder
+        self.protocol.Exporter = exporter
+        self.protocol.ExportName = os.path.splitext(name)[0]
+        if isinstance(connection, CaptureConnection):
+            connection.Attach(self.protocol, self.buffa)
+
+    # take in the next batch, returns its arrival time or None if there was none
+    def Ingest(self, meter):
+        batch = self.connection.ReceiveBatch()
+        if batch == None:
+            return None
+        stamp, lines = batch
+        now = clocktime()
+        if isinstance(lines, Records):
+            self.protocol.ProcessRecords(lines)
+        else:
+            lines = [line.strip() for line in lines]
+            for line in lines:
+                self.buffa.NewLine(line)
+            now, then = clocktime(), now
+            meter.Add('buffer', now - then)
+            self.protocol.ProcessLines(lines)
+        meter.Add('parse', clocktime() - now)
+        meter.Lines(len(lines))
+        return stamp
+
+    def Close(self):
+        self.connection.Close()
+        if self.recorder != None:
+            self.recorder.Close()
 
-def main(connection):
-    global Running, SeparatorPosition, Dimension
+# names are the sources' paths, records go to one capture per source,
+# stats to a file of PerfMeter rows; hud shows them from the start. Stopped
+# runs are exported with exporter if autoexport, Ctrl-E exports the current one.
+def main(connections, names, record=None, stats=None, hud=False, exporter=None, autoexport=False):
+    global Running, SeparatorPosition, Dimension, TabBarHeight, Font
 
     state = DEFULAT
+    if exporter == None:
+        exporter = RunExporter()
 
     pygame.init()
     pygame.display.set_caption("Motori monitor")
     screen = pygame.display.set_mode(Dimension, pygame.HWSURFACE|pygame.DOUBLEBUF|pygame.RESIZABLE)
     clock = pygame.time.Clock() 
     Running = True
-
-    protocol = DataProtocol()
-    buffa = Buffer()
-    graph = Graph(PlotRect().size, protocol)
-    status = TextWin(buffa, (Dimension[0], TextWinHeight()))
-
-    connection.Enable(True)
+    if Font == None:
+        Font = pygame.font.SysFont(FontName, FontSize)
+    TabBarHeight = LineHeight + 4 if Layout == 'tabs' and len(connections) > 1 else 0
+
+    rects = ChannelRects(len(connections))
+    channels = []
+    for index, (connection, name) in enumerate(zip(connections, names)):
+        path = record
+        if record != None and len(connections) > 1:
+            path = '%s-%d%s' % (os.path.splitext(record)[0], index + 1, os.path.splitext(record)[1])
+        channels.append(Channel(connection, name, rects[index].size, path, exporter if autoexport else None))
+    # the source keys, the text window and the tab bar belong to
+    active = 0
+
+    for channel in channels:
+        channel.connection.Enable(True)
+
+    # arrival time of the oldest line not yet on screen
+    arrival = None
+    latency = LatencyMeter()
+    meter = PerfMeter(stats)
+    # looked at four times a period so that no period is skipped
+    pygame.time.set_timer(TIMEREVENT, int(250 * meter.Period))
+
+    # time for ingest per frame, adjusted to what painting leaves over
+    budget = 0.5 / FrameRate
+    lastframe = 0.0
+    backlog = False
 
     repaint = True
     while Running:
-        event = pygame.event.wait()
-        if event.type == pygame.QUIT:
-            Running = False
-            connection.Close()
+        # input first; block only when there is nothing to ingest or paint
+        if backlog or repaint:
+            events = pygame.event.get()
         else:
-            if event.type == pygame.VIDEORESIZE:
+            events = [pygame.event.wait()] + pygame.event.get()
+        for event in events:
+            graph, status = channels[active].graph, channels[active].status
+            if event.type == pygame.QUIT:
+                Running = False
+                for channel in channels:
+                    channel.Close()
+                meter.Due([channel.connection for channel in channels], True)
+                meter.Close()
+                exporter.Close()
+                break
+            elif event.type == pygame.VIDEORESIZE:
                 Dimension = event.dict['size']
                 screen=pygame.display.set_mode(Dimension, pygame.HWSURFACE|pygame.DOUBLEBUF|pygame.RESIZABLE)
                 if SeparatorPosition >= Dimension[1] - int(Dimension[1] * 0.1):
                     SeparatorPosition = Dimension[1] - int(Dimension[1] * 0.1)
-                graph.Resize(PlotRect().size)
-                status.Resize((Dimension[0], TextWinHeight()))
+                rects = ChannelRects(len(channels))
+                for channel, rect in zip(channels, rects):
+                    channel.graph.Resize(rect.size)
+                    channel.status.Resize((Dimension[0], TextWinHeight()))
                 repaint = True
             elif event.type == pygame.KEYDOWN:                
                 if ((event.mod & (pygame.KMOD_LMETA | pygame.KMOD_RMETA)) != 0) and (event.key == pygame.K_q):
                     pygame.event.post(pygame.event.Event(pygame.QUIT))
-                else:
-                    connection.Send(event.unicode)
+                elif ((event.mod & (pygame.KMOD_META | pygame.KMOD_CTRL)) != 0) and (event.key == pygame.K_f):
+                    status.StartSearch()
+                    repaint = True
+                elif ((event.mod & (pygame.KMOD_META | pygame.KMOD_CTRL)) != 0) and \
+                        (event.key >= pygame.K_0) and (event.key <= pygame.K_9):
+                    graph.ToggleOverlay(event.key - pygame.K_0)
+                    repaint = True
+                elif ((event.mod & (pygame.KMOD_META | pygame.KMOD_CTRL)) != 0) and (event.key == pygame.K_v):
+                    graph.CycleVelocityFilter()
+                    repaint = True
+                elif ((event.mod & (pygame.KMOD_META | pygame.KMOD_CTRL)) != 0) and (event.key == pygame.K_e):
+                    run = channels[active].protocol.Snapshot()
+                    if run != None:
+                        exporter.Export(run, channels[active].protocol.ExportName)
+                elif ((event.mod & (pygame.KMOD_META | pygame.KMOD_CTRL)) != 0) and (event.key == pygame.K_i):
+                    hud = not hud
+                    repaint = True
+                elif (event.key >= pygame.K_F1) and (event.key - pygame.K_F1 < len(channels)):
+                    active = event.key - pygame.K_F1
+                    repaint = True
+                elif ((event.mod & pygame.KMOD_CTRL) != 0) and (event.key == pygame.K_TAB):
+                    active = (active + 1) % len(channels)
+                    repaint = True
+                elif status.Searching():
+                    status.SearchKey(event)
+                    repaint = True
+                elif channels[active].connection.Send(event.unicode) and \
+                        isinstance(channels[active].connection, CaptureConnection):
+                    repaint = True
             elif event.type == SERIALEVENT:
-                framestart = pygame.time.get_ticks()
-                valid = True
-                while pygame.time.get_ticks() - framestart < 250:
-                    line = connection.ReceiveLine()
-                    if line == None:
-                        break
-                    line = line.strip()
-                    buffa.NewLine(line)
-                    protocol.ProcessData(line)
+                backlog = True
+            elif event.type == TIMEREVENT:
+                if meter.Due([channel.connection for channel in channels]) and hud:
                     repaint = True
             elif event.type == pygame.MOUSEBUTTONDOWN:
+                # the source whose plot is under the mouse
+                plot = None
+                for index, rect in enumerate(rects):
+                    if rect.collidepoint(event.pos) and (Layout != 'tabs' or index == active):
+                        plot = index
+                if plot != None:
+                    pos = (event.pos[0] - rects[plot].left, event.pos[1] - rects[plot].top)
                 if (event.pos[1] >= SeparatorPosition - 1) and (event.pos[1] <= SeparatorPosition + 1):
                     state = RESIZE
-                if event.button == 5:
+                elif event.button == 1:
+                    # a click on a tab or a stacked plot picks its source,
+                    # a drag on a plot pans it
+                    targets = TabRects(channels) if TabBarHeight > 0 else rects
+                    for index, rect in enumerate(targets):
+                        if rect.collidepoint(event.pos) and index != active:
+                            active = index
+                            repaint = True
+                    if plot != None:
+                        channels[plot].graph.StartPan(pos)
+                        state = PAN
+                elif event.button == 3 and plot != None:
+                    channels[plot].graph.ResetView()
+                    repaint = True
+                if event.button in (4, 5) and plot != None:
+                    graph = channels[plot].graph
+                    graph.Zoom(pos, graph.ZoomStep if event.button == 4 else 1 / graph.ZoomStep)
+                    repaint = True
+                elif event.button == 5:
                     status.ScrollDown()
                     repaint = True
-                if event.button == 4:
+                elif event.button == 4:
                     status.ScrollUp()
                     repaint = True
             elif event.type == pygame.MOUSEBUTTONUP:
                     state = DEFULAT
+                    for channel in channels:
+                        channel.graph.EndPan()
             elif event.type == pygame.MOUSEMOTION:
                 if state == DEFULAT:
                     if (event.pos[1] >= SeparatorPosition - 1) and (event.pos[1] <= SeparatorPosition + 1):
                         pygame.mouse.set_cursor(*pygame.cursors.broken_x)
                     else:
                         pygame.mouse.set_cursor(*pygame.cursors.arrow)
-                        graph.MouseMove((event.pos[0] - PlotRect().left, event.pos[1] - PlotRect().top))
+                        for index, (channel, rect) in enumerate(zip(channels, rects)):
+                            if index == active or (Layout != 'tabs' and rect.collidepoint(event.pos)):
+                                channel.graph.MouseMove((event.pos[0] - rect.left, event.pos[1] - rect.top))
+                elif state == PAN:
+                    for channel, rect in zip(channels, rects):
+                        channel.graph.Pan((event.pos[0] - rect.left, event.pos[1] - rect.top))
                 elif state == RESIZE:
                     SeparatorPosition = event.pos[1]
-                    graph.Resize(PlotRect().size)
-                    status.Resize((Dimension[0], TextWinHeight()))
+                    rects = ChannelRects(len(channels))
+                    for channel, rect in zip(channels, rects):
+                        channel.graph.Resize(rect.size)
+                        channel.status.Resize((Dimension[0], TextWinHeight()))
                 repaint = True
-            if repaint:
-                screen.blit(graph.Paint(), PlotRect().topleft)
-                screen.blit(status.Paint(), (0, SeparatorPosition))
-                pygame.draw.line(screen, SeparatorColor, (0, SeparatorPosition - 1), (screen.get_width(), SeparatorPosition - 1), 3)
-                pygame.display.flip()
-                repaint = False
+        if not Running:
+            break
+
+        # ingest from all sources in turn until the budget is spent or input
+        # shows up; whatever is left stays queued and backlog says so
+        if backlog:
+            ingeststart = clocktime()
+            waiting = list(channels)
+            while len(waiting) > 0:
+                for channel in list(waiting):
+                    stamp = channel.Ingest(meter)
+                    if stamp == None:
+                        waiting.remove(channel)
+                    else:
+                        repaint = True
+                        if arrival == None or stamp < arrival:
+                            arrival = stamp
+                if clocktime() - ingeststart >= budget or pygame.event.peek(InputEvents):
+                    break
+            backlog = len(waiting) > 0
+
+        # repaints are coalesced to FrameRate
+        now = clocktime()
+        if repaint and now - lastframe < 1.0 / FrameRate:
+            if not backlog:
+                pygame.time.wait(int(1000 * (lastframe + 1.0 / FrameRate - now)) + 1)
+        elif repaint:
+            lastframe = now
+            shown = [active] if Layout == 'tabs' else range(len(channels))
+            for index in shown:
+                channels[index].protocol.Crossings()
+            now, then = clocktime(), now
+            meter.Add('crossings', now - then)
+            if Layout == 'tabs':
+                screen.blit(channels[active].graph.Paint(), rects[active].topleft)
+            else:
+                for index, (channel, rect) in enumerate(zip(channels, rects)):
+                    screen.blit(channel.graph.Paint(), rect.topleft)
+                    if len(channels) > 1:
+                        label = Font.render(channel.name, 0, PlotTextColor,
+                            TextMarkerBgColor if index == active else BgColor)
+                        screen.blit(label, (rect.right - label.get_width() - 24, rect.top + 2))
+            now, then = clocktime(), now
+            meter.Add('graph', now - then)
+            screen.blit(channels[active].status.Paint(), (0, SeparatorPosition))
+            now, then = clocktime(), now
+            meter.Add('text', now - then)
+            if TabBarHeight > 0:
+                screen.fill(BgColor, (0, 0, Dimension[0], PlotRect().top))
+                for index, (channel, rect) in enumerate(zip(channels, TabRects(channels))):
+                    if index == active:
+                        screen.fill(TextMarkerBgColor, rect)
+                    pygame.draw.rect(screen, PlotFrameColor, rect, 1)
+                    label = Font.render(channel.name, 0, PlotTextColor)
+                    screen.blit(label, (rect.left + 8, rect.centery - label.get_height() / 2))
+            pygame.draw.line(screen, SeparatorColor, (0, SeparatorPosition - 1), (screen.get_width(), SeparatorPosition - 1), 3)
+            if hud:
+                PaintHud(screen, meter.Report())
+            pygame.display.flip()
+            meter.Frame()
+            repaint = False
+            budget = max(MinIngestShare / FrameRate, 1.0 / FrameRate - (clocktime() - lastframe))
+            if arrival != None:
+                latency.Add(clocktime() - arrival)
+                arrival = None
+                if latency.Due():
+                    pygame.display.set_caption('Motori monitor - %s, backlog %d batches, %d lines dropped' %
+                        (latency.Report(), sum(channel.connection.queue.qsize() for channel in channels),
+                         sum(channel.connection.dropped for channel in channels)))
+
+# synthetic step response: a damped oscillation settling on a setpoint
+def StepResponse(count, setpoint=1000, period=400, decay=2000.0):
+    last = 0
+    for i in xrange(count):
+        t = i * 10
+        q = int(setpoint * (1 - exp(-i / decay) * cos(6.2832 * i / period)))
+        # the board reports velocity as the period between encoder steps
+        yield (t, q, 200 / (abs(q - last) + 1) + 1)
+        last = q
+
+# ingest cost per sample as the run grows, crossings queried once per batch
+# the way a repaint would do it
+def BenchmarkIngest(total=200000, window=10000, batch=100):
+    print 'DataProtocol.Sample ingest cost, %d samples' % total
+    print '%10s %12s %10s' % ('samples', 'us/sample', 'crossings')
+    protocol = DataProtocol()
+    protocol.Start()
+    start = clocktime()
+    for samp in StepResponse(total):
+        protocol.Sample(samp)
+        if protocol.Count() % batch == 0:
+            protocol.Crossings()
+        if protocol.Count() % window == 0:
+            now = clocktime()
+            print '%10d %12.2f %10d' % (protocol.Count(), 1e6 * (now - start) / window, len(protocol.crossings))
+            start = now
+
+# screenlog.0 style input: sample lines with an occasional debug line
+def SampleLines(count):
+    for i, samp in enumerate(StepResponse(count)):
+        if i % 50 == 0:
+            yield 'Enabled=1 Speed=0 Power=150'
+        yield 'T=%d Q=%d vel=%d S=%d' % (samp[0], samp[1], samp[2], i % 100)
+
+# the same as SampleLines, samples packed 16 to a SLIP frame
+def SampleFrames(count, perframe=16):
+    chunk = []
+    samples = array('i')
+    for i, samp in enumerate(StepResponse(count)):
+        if i % 50 == 0:
+            chunk.append('Enabled=1 Speed=0 Power=150\n')
+        samples.extend(samp)
+        if len(samples) == perframe * len(RecordLayout):
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            chunk.append(SlipFrame(samples.tostring()))
+            samples = array('i')
+        if len(chunk) >= 64:
+            yield ''.join(chunk)
+            chunk = []
+    if len(samples) > 0:
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        chunk.append(SlipFrame(samples.tostring()))
+    yield ''.join(chunk)
+
+# line parser throughput, batches as the serial reader would hand them over
+def BenchmarkParse(total=500000, batch=1000):
+    lines = list(SampleLines(total))
+    batches = [lines[i:i + batch] for i in xrange(0, len(lines), batch)]
+    print 'Line parser throughput, %d lines in batches of %d' % (len(lines), batch)
+
+    schema = LineSchema(SampleFormat)
+    start = clocktime()
+    for chunk in batches:
+        schema.Parse('\n'.join(chunk))
+    elapsed = clocktime() - start
+    print '%-28s %10.0f lines/s' % ('LineSchema.Parse', len(lines) / elapsed)
 
-def usage(appname):
-    print 'Usage: %s <serial_device> <serial_speed>' % appname
-    print 'Example: %s /dev/tty.SLAB_USBtoUART 230400' % appname
+    protocol = DataProtocol()
+    protocol.Start()
+    start = clocktime()
+    for chunk in batches:
+        protocol.ProcessLines(chunk)
+    elapsed = clocktime() - start
+    print '%-28s %10.0f lines/s' % ('DataProtocol.ProcessLines', len(lines) / elapsed)
+
+    protocol.Start()
+    start = clocktime()
+    for line in lines[:total / 10]:
+        protocol.ProcessData(line)
+    elapsed = clocktime() - start
+    print '%-28s %10.0f lines/s' % ('DataProtocol.ProcessData', total / 10 / elapsed)
+
+def PeakMemory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OSX
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+# Replay a connection as fast as it delivers through DataProtocol and Buffer,
+# and optionally paint Graph and TextWin at up to fps frames per second on
+# the dummy video driver. Reports lines/s, time per stage and peak memory.
+# With record the session is written to a capture file on the way, with
+# stats the PerfMeter rows to that file. With exporter every run, including
+# one still going when the input ends, is exported as name-runN.
+def Headless(connection, paint=False, fps=30, record=None, stats=None, exporter=None, name='run'):
+    global Font
+    pygame.display.init()
+    pygame.font.init()
+    Font = pygame.font.SysFont(FontName, FontSize)
+    protocol = DataProtocol()
+    buffa = Buffer()
+    recorder = CaptureWriter(record) if record != None else None
+    protocol.Recorder = recorder
+    protocol.Exporter = exporter
+    protocol.ExportName = name
+    if paint:
+        screen = pygame.display.set_mode(Dimension)
+        graph = Graph(PlotRect().size, protocol)
+        status = TextWin(buffa, (Dimension[0], TextWinHeight()))
+
+    stages = OrderedDict((stage, 0.0) for stage in ('read', 'buffer', 'parse', 'crossings', 'paint'))
+    meter = PerfMeter(stats)
+    lines, records, frames, lastframe = 0, 0, 0, 0.0
+    connection.Enable(True)
+    started = clocktime()
+    while not connection.Drained():
+        now = clocktime()
+        batch = connection.WaitBatch(0.1)
+        stages['read'] += clocktime() - now
+        if batch == None:
+            continue
+
+        now = clocktime()
+        if isinstance(batch[1], Records):
+            records = records + len(batch[1])
+            protocol.ProcessRecords(batch[1])
+            now, then = clocktime(), now
+            stages['parse'] += now - then
+            meter.Lines(len(batch[1]))
+        else:
+            batch = [line.strip() for line in batch[1]]
+            for line in batch:
+                buffa.NewLine(line)
+            lines = lines + len(batch)
+            now, then = clocktime(), now
+            stages['buffer'] += now - then
+            meter.Add('buffer', now - then)
+
+            protocol.ProcessLines(batch)
+            now, then = clocktime(), now
+            stages['parse'] += now - then
+            meter.Lines(len(batch))
+        meter.Add('parse', now - then)
+
+        if paint and now - lastframe >= 1.0 / fps:
+            lastframe = now
+            screen.blit(graph.Paint(), PlotRect().topleft)
+            screen.blit(status.Paint(), (0, SeparatorPosition))
+            frames = frames + 1
+            stages['paint'] += clocktime() - now
+            meter.Add('graph', clocktime() - now)
+            meter.Frame()
+        else:
+            protocol.Crossings()
+            stages['crossings'] += clocktime() - now
+            meter.Add('crossings', clocktime() - now)
+        meter.Due([connection])
+    elapsed = clocktime() - started
+    meter.Due([connection], True)
+    meter.Close()
+    if exporter != None:
+        if not protocol.finished and protocol.Count() > 0:
+            protocol.Finish()
+        exporter.Close()
+    if recorder != None:
+        recorder.Close()
+
+    # binary records count as lines
+    lines = lines + records
+    print '%d lines, %d binary records, %d samples in last run, %.2f s, %.0f lines/s' % \
+        (lines, records, protocol.Count(), elapsed, lines / elapsed if elapsed > 0 else 0)
+    for stage, spent in stages.items():
+        print '%-10s %8.3f s %6.1f%% %8.2f us/line' % \
+            (stage, spent, 100.0 * spent / elapsed if elapsed > 0 else 0, 1e6 * spent / max(lines, 1))
+    if paint:
+        print '%d frames painted' % frames
+    print 'peak memory %.1f MB, %d lines dropped, %d bad frames' % \
+        (PeakMemory(), connection.dropped, connection.badframes)
+
+# Offline analysis of every run of a text log or capture on a pool of worker
+# processes. The parent only finds the run boundaries, from the log index or
+# the capture index; each worker maps the file itself, replays its runs
+# through DataProtocol and paints thumbnails on the dummy video driver, so
+# nothing but the rows of the table goes between processes.
+BatchFields = ('run', 'samples', 'duration_ms', 'crossings', 'rise_ms', 'overshoot_pct',
+    'settling_ms', 'error', 'period_ms', 'final_position', 'thumbnail')
+# the fields written as integers, the other numbers are written in full by repr
+BatchIntegers = ('run', 'samples', 'crossings', 'final_position')
+
+# files opened by this worker process, by path
+batchFiles = {}
+
+def BatchWorkerInit():
+    global Font
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()
+    pygame.font.init()
+    pygame.display.set_mode((1, 1))
+    Font = pygame.font.SysFont(FontName, FontSize)
+
+# metrics and thumbnail of run n, in bytes start to stop of a text log or by
+# number in a capture; a row of BatchFields
+def AnalyseRun(job):
+    path, n, start, stop, thumbnails, size = job
+    protocol = DataProtocol()
+    if path not in batchFiles:
+        if IsCapture(path):
+            batchFiles[path] = Capture(path)
+        else:
+            with open(path, 'rb') as f:
+                batchFiles[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    source = batchFiles[path]
+    if isinstance(source, Capture):
+        source.LoadRun(n, protocol)
+    else:
+        protocol.ProcessLines([line.strip() for line in source[start:stop].split('\n')])
+
+    count = protocol.Count()
+    row = OrderedDict((field, None) for field in BatchFields)
+    row['run'], row['samples'] = n + 1, count
+    if count > 0:
+        samples = protocol.Samples(1)
+        metrics = protocol.Metrics()
+        row['duration_ms'] = samples[-1][0] - samples[0][0]
+        row['crossings'] = len(protocol.Crossings())
+        for field, name in (('rise_ms', 'rise'), ('overshoot_pct', 'overshoot'),
+                ('settling_ms', 'settling'), ('error', 'error'), ('period_ms', 'period')):
+            row[field] = metrics[name]
+        row['final_position'] = samples[-1][1]
+    if thumbnails != None and count > 1:
+        row['thumbnail'] = os.path.join(thumbnails, 'run%05d.png' % (n + 1))
+        # a run cut short by the next START is fitted like a stopped one, and
+        # the layer under the mouse cursor overlay is saved
+        if not protocol.finished:
+            protocol.Finish()
+        graph = Graph(size, protocol)
+        graph.Paint()
+        pygame.image.save(graph.layer, row['thumbnail'])
+    return row
+
+# a field of a runs.csv row as text, empty when there is no value
+def BatchValue(field, value):
+    if value == None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if field in BatchIntegers:
+        return '%d' % value
+    return repr(float(value))
+
+# Analyse all runs of path with jobs processes, writing runs.csv and, unless
+# size is None, run<N>.png thumbnails of that size to directory
+def Batch(path, directory, jobs, size=(480, 300)):
+    if IsCapture(path):
+        capture = Capture(path)
+        runs = [(None, None)] * len(capture.Runs())
+        capture.Close()
+    else:
+        log = FileConnection(path)
+        log.WaitIndex()
+        runs = log.Runs()
+        log.Close()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    thumbnails = directory if size != None else None
+    work = [(path, n, start, stop, thumbnails, size) for n, (start, stop) in enumerate(runs)]
+
+    started = clocktime()
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, BatchWorkerInit)
+        rows = pool.imap(AnalyseRun, work, max(1, len(work) / (8 * jobs)))
+    else:
+        BatchWorkerInit()
+        pool, rows = None, imap(AnalyseRun, work)
+    with open(os.path.join(directory, 'runs.csv'), 'w') as out:
+        out.write(','.join(BatchFields) + '\n')
+        for row in rows:
+            out.write(','.join(BatchValue(field, value) for field, value in row.items()) + '\n')
+    if pool != None:
+        pool.close()
+        pool.join()
+    elapsed = clocktime() - started
+    print '%d runs in %.2f s on %d processes, %.1f runs/s, table in %s' % \
+        (len(work), elapsed, jobs, len(work) / elapsed if elapsed > 0 else 0, os.path.join(directory, 'runs.csv'))
 
 if __name__=="__main__":
-    if len(sys.argv) == 1:
-        usage(sys.argv[0])
+    parser = argparse.ArgumentParser(description='Serial terminal with position and velocity plots.',
+        epilog='Example: %(prog)s /dev/tty.SLAB_USBtoUART 230400')
+    parser.add_argument('sources', nargs='*', metavar='device [speed]',
+        help='serial devices, each optionally followed by its speed (default 9600), '
+             'or text logs and capture files to replay')
+    parser.add_argument('--layout', choices=('tabs', 'stack'), default=Layout,
+        help='show the plots of several sources one at a time or one above the other')
+    parser.add_argument('--format', default=SampleFormat,
+        help="sample line layout as KEY=role fields, roles time, qenc and vel are required, "
+             "others are kept as extra columns, a trailing ? marks an optional field "
+             "(default '%(default)s')")
+    parser.add_argument('--headless', action='store_true',
+        help='replay the device or --synthetic input as fast as possible without a window and report throughput')
+    parser.add_argument('--synthetic', type=int, metavar='N', help='generate N samples of input instead of a device')
+    parser.add_argument('--binary', action='store_true', help='generate --synthetic samples as SLIP framed records')
+    parser.add_argument('--paint', action='store_true', help='paint the graph and text while replaying headless')
+    parser.add_argument('--framing', choices=('auto', 'text'), default=Connection.Framing,
+        help='decode SLIP framed binary records between text lines (auto) or take all input as text')
+    parser.add_argument('--fps', type=int, default=FrameRate, help='frames painted per second at most (default %(default)s)')
+    parser.add_argument('--settling-band', type=float, default=100 * DataProtocol.SettlingBand, metavar='PERCENT',
+        help='band around the setpoint a run counts as settled in, in %% of the step (default %(default)g)')
+    parser.add_argument('--vel-filter', default=DataProtocol.VelocityFilterSpec, metavar='SPEC',
+        help='velocity filter chain, e.g. reject:15:4,median:5,ema:0.3 (also ma:N); Ctrl-V steps through presets')
+    parser.add_argument('--strip', metavar='SPAN',
+        help='strip chart of the last SPAN samples, or seconds with an s suffix (e.g. 30s), for streams without START')
+    parser.add_argument('--overlay', type=int, default=0, metavar='N',
+        help='overlay the last N runs under the current one (default %(default)s)')
+    parser.add_argument('--record', metavar='FILE', help='record the session to a capture file')
+    parser.add_argument('--stats', metavar='FILE',
+        help='write throughput and time per stage every second to a CSV file, or JSON lines if FILE ends in .json')
+    parser.add_argument('--hud', action='store_true', help='show the performance figures on screen, Ctrl-I toggles them')
+    parser.add_argument('--export', choices=ExportFormats,
+        help='export every stopped run to a file of this format; Ctrl-E exports the current run')
+    parser.add_argument('--export-dir', default='.', metavar='DIR', help='directory runs are exported to (default %(default)s)')
+    parser.add_argument('--batch', metavar='DIR',
+        help='analyse every run of a text log or capture file, writing a table of figures and thumbnails to DIR')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), metavar='N',
+        help='processes for --batch (default %(default)s)')
+    parser.add_argument('--thumbnail', default='480x300', metavar='WxH',
+        help='size of the --batch thumbnails, 0 for none (default %(default)s)')
+    parser.add_argument('--runs', action='store_true', help='list the runs of a capture file or text log')
+    parser.add_argument('--bench', action='store_true', help='measure data ingest cost per sample')
+    parser.add_argument('--bench-parse', action='store_true', help='measure line parser throughput')
+    options = parser.parse_args()
+
+    try:
+        LineSchema(options.format)
+        VelocityFilter(options.vel_filter)
+    except ValueError as e:
+        print e
         sys.exit(1)
-    device, speed = None, 9600
-    if len(sys.argv) > 1:
-        device = sys.argv[1]
-    if len(sys.argv) > 2:
+    SampleFormat = options.format
+    Connection.Framing = options.framing
+    FrameRate = max(options.fps, 1)
+    Graph.OverlayLast = max(options.overlay, 0)
+    DataProtocol.SettlingBand = options.settling_band / 100.0
+    DataProtocol.VelocityFilterSpec = options.vel_filter.strip()
+    if DataProtocol.VelocityFilterSpec not in VelocityFilters:
+        VelocityFilters.insert(1, DataProtocol.VelocityFilterSpec)
+    Layout = options.layout
+    if options.strip != None:
         try:
-            speed = int(sys.argv[2])
-        except:
-            print '%s does not look like an serial speed' % sys.argv[2]
+            if options.strip.endswith('s'):
+                DataProtocol.StripSeconds = float(options.strip[:-1])
+            else:
+                DataProtocol.StripSamples = int(options.strip)
+        except ValueError:
+            parser.error('--strip takes a number of samples or seconds like 30s')
+
+    # a number after a device is its speed
+    sources = []
+    for token in options.sources:
+        if token.isdigit() and len(sources) > 0 and sources[-1][1] == None:
+            sources[-1][1] = int(token)
+        else:
+            sources.append([token, None])
+    options.device = sources[0][0] if len(sources) > 0 else None
+
+    if options.bench:
+        BenchmarkIngest()
+        sys.exit(0)
+    if options.bench_parse:
+        BenchmarkParse()
+        sys.exit(0)
+    if options.runs:
+        if options.device == None or not os.path.isfile(options.device):
+            print 'A capture file or text log is needed to list runs'
             sys.exit(1)
+        if IsCapture(options.device):
+            for n, (offset, samples, lines) in enumerate(Capture(options.device).Runs()):
+                print 'run %4d: %10d samples %10d lines at offset %d' % (n + 1, samples, lines, offset)
+        else:
+            log = FileConnection(options.device)
+            log.WaitIndex()
+            for n, (start, stop) in enumerate(log.Runs()):
+                print 'run %4d: line %10d, %10d bytes at offset %d' % (n + 1, log.LineAt(start) + 1, stop - start, start)
+        sys.exit(0)
+    if options.batch != None:
+        if options.device == None or not os.path.isfile(options.device):
+            print 'A capture file or text log is needed for --batch'
+            sys.exit(1)
+        size = None
+        if options.thumbnail != '0':
+            try:
+                size = tuple(int(n) for n in options.thumbnail.lower().split('x'))
+                if len(size) != 2 or min(size) < 16:
+                    raise ValueError
+            except ValueError:
+                parser.error('--thumbnail takes a size like 480x300, or 0')
+        Batch(options.device, options.batch, max(options.jobs, 1), size)
+        sys.exit(0)
+    exporter = RunExporter(options.export_dir, options.export or 'csv')
+    if options.headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        if options.export == None:
+            exporter = None
+        if options.synthetic != None:
+            Headless(SyntheticConnection(options.synthetic, options.binary), options.paint, FrameRate,
+                options.record, options.stats, exporter, 'synthetic')
+        elif options.device != None:
+            Headless(FileConnection(options.device), options.paint, FrameRate,
+                options.record, options.stats, exporter, os.path.splitext(os.path.basename(options.device))[0])
+        else:
+            parser.print_usage()
+            sys.exit(1)
+        sys.exit(0)
+    if len(sources) == 0:
+        parser.print_usage()
+        sys.exit(1)
 
-    connection = None
-    try:
-        connection = SerialConnection(device, speed)
-    except:
-        print 'Could not open device %s with speed %s' % (device, speed)
-
-    if connection == None:
+    connections = []
+    multiplexer = Multiplexer() if Multiplexer.Supported else None
+    for device, speed in sources:
+        if speed == None:
+            speed = 9600
+        connection = None
+        if IsCapture(device):
+            try:
+                connection = CaptureConnection(device)
+            except (ValueError, EnvironmentError) as e:
+                print 'Could not open capture %s: %s' % (device, e)
+                sys.exit(1)
+            connections.append(connection)
+            continue
         try:
-            connection = FileConnection(device)
+            connection = SerialConnection(device, speed)
         except:
-            print 'Could not open text file %s either' % (device)
-            sys.exit(1)
-
-
-    main(connection)
+            print 'Could not open device %s with speed %s' % (device, speed)
+
+        if connection == None:
+            try:
+                connection = FileConnection(device)
+            except:
+                print 'Could not open text file %s either' % (device)
+                sys.exit(1)
+        if multiplexer != None:
+            multiplexer.Add(connection)
+        connections.append(connection)
+
+    main(connections, [os.path.basename(device) for device, speed in sources], options.record, options.stats, options.hud,
+        exporter, options.export != None)